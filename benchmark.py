@@ -0,0 +1,303 @@
+"""Module for benchmarking BPM estimators"""
+
+import json
+import platform
+import random
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import mido
+import numpy as np
+
+from rich import print as rprint
+
+import bpmlib
+import midia
+from note import DEFAULT_PPQN
+
+FIXTURE_DIRS = ("sample/overestimated_bpm", "sample/underestimated_bpm")
+
+# name: (estimator taking the wav or mid path, input suffix)
+ESTIMATORS = {
+    "librosa": (bpmlib.bpm_estimator_librosa, ".wav"),
+    "librosa_stream": (bpmlib.bpm_estimator_librosa_stream, ".wav"),
+    "librosa_candidates": (
+        lambda path: bpmlib.bpm_candidates_librosa(path).bpms,
+        ".wav",
+    ),
+    "pretty_midi": (bpmlib.bpm_estimator_pretty_midi, ".mid"),
+    "midi": (bpmlib.bpm_from_midi_file, ".mid"),
+}
+
+
+def create_synthetic_midi(midi_path, bpm, measure_num=16, seed=0):
+    """Create a one track melody midi file with a known tempo"""
+    rng = random.Random(seed)
+    mid = mido.MidiFile(ticks_per_beat=DEFAULT_PPQN)
+    track = mido.MidiTrack()
+    mid.tracks.append(track)
+    track.append(mido.MetaMessage("set_tempo", tempo=mido.bpm2tempo(bpm)))
+    track.append(
+        mido.MetaMessage("time_signature", numerator=4, denominator=4)
+    )
+    rest = 0
+    for _ in range(measure_num):
+        beat = 0
+        while beat < 4:
+            length = min(rng.choice((0.5, 1, 1, 2)), 4 - beat)
+            beat += length
+            if rng.random() < 0.1:
+                rest += int(length * DEFAULT_PPQN)
+                continue
+            note = rng.randint(55, 79)
+            track.append(
+                mido.Message("note_on", note=note, velocity=80, time=rest)
+            )
+            track.append(
+                mido.Message(
+                    "note_off",
+                    note=note,
+                    velocity=64,
+                    time=int(length * DEFAULT_PPQN),
+                )
+            )
+            rest = 0
+    track.append(mido.MetaMessage("end_of_track", time=rest))
+    mid.save(midi_path)
+
+
+def prepare_fixtures(work_dir, bpms=None, fixture_dirs=FIXTURE_DIRS):
+    """Create synthetic midi/wav pairs and render wav of fixture midi files
+
+    Files already rendered in work_dir are reused.
+
+    Returns:
+        list of (wav path, mid path)
+    """
+    if bpms is None:
+        bpms = range(60, 181, 20)
+    work_dir = Path(work_dir)
+    work_dir.mkdir(exist_ok=True, parents=True)
+    midi_paths = []
+    for i, bpm in enumerate(bpms):
+        midi_path = work_dir / f"synthetic_{bpm}bpm.mid"
+        if not midi_path.exists():
+            create_synthetic_midi(midi_path, bpm, seed=i)
+        midi_paths.append(midi_path)
+    for fixture_dir in fixture_dirs:
+        midi_paths += sorted(Path(fixture_dir).glob("*.mid"))
+
+    samples = []
+    for midi_path in midi_paths:
+        wav_path = work_dir / midi_path.with_suffix(".wav").name
+        if not wav_path.exists():
+            midia.midi2wav(
+                mido.MidiFile(midi_path),
+                wav_path,
+                bpmlib.bpm_from_midi_file(midi_path),
+            )
+        samples.append((wav_path, midi_path))
+    return samples
+
+
+def _peak_memory(estimator, path):
+    tracemalloc.start()
+    try:
+        estimator(path)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_estimator(estimator, suffix, samples, measure_memory=True):
+    """Benchmark an estimator over (wav path, mid path) samples
+
+    Latency is measured without tracemalloc; peak memory of a call is
+    measured by a second, traced call.
+    """
+    files = []
+    for wav_path, midi_path in samples:
+        path = wav_path if suffix == ".wav" else midi_path
+        begin = time.perf_counter()
+        estimated_bpm = float(np.ravel(estimator(path))[0])
+        seconds = time.perf_counter() - begin
+        files.append(
+            {
+                "path": str(path),
+                "reference_bpm": bpmlib.bpm_from_midi_file(midi_path),
+                "estimated_bpm": estimated_bpm,
+                "seconds": seconds,
+                "peak_memory": (
+                    _peak_memory(estimator, path) if measure_memory else None
+                ),
+            }
+        )
+
+    errors = bpmlib.bpm_error(
+        [file["estimated_bpm"] for file in files],
+        [file["reference_bpm"] for file in files],
+    )
+    statistics = bpmlib.BpmErrorStatistics()
+    statistics.update(errors)
+    for file, error in zip(files, errors):
+        file["error"] = float(error["error"])
+        file["selected_error"] = bpmlib.BPM_CORRECTION_NAMES[
+            error["selected_error"]
+        ]
+    total_seconds = sum(file["seconds"] for file in files)
+    summary = {
+        "file_num": len(files),
+        "total_seconds": total_seconds,
+        "throughput": len(files) / total_seconds,
+        "mean_seconds": total_seconds / len(files),
+        "max_seconds": max(file["seconds"] for file in files),
+        "peak_memory": (
+            max(file["peak_memory"] for file in files)
+            if measure_memory
+            else None
+        ),
+        "error": {
+            name: {"mean": float(mean), "std": float(std)}
+            for (_, name), mean, std in zip(
+                statistics.FIELDS, statistics.mean(), statistics.std()
+            )
+        },
+        "selected_error": dict(
+            zip(
+                bpmlib.BPM_CORRECTION_NAMES,
+                statistics.selected_error_frequencies.tolist(),
+            )
+        ),
+    }
+    return {"summary": summary, "files": files}
+
+
+def run_benchmark(
+    work_dir="benchmark_fixtures",
+    result_path=None,
+    estimators=None,
+    bpms=None,
+    measure_memory=True,
+):
+    """Benchmark estimators and save the result as json"""
+    samples = prepare_fixtures(work_dir, bpms=bpms)
+    if estimators is None:
+        estimators = list(ESTIMATORS)
+    result = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "estimators": {},
+    }
+    for name in estimators:
+        estimator, suffix = ESTIMATORS[name]
+        # warm up caches and numba compilation
+        estimator(samples[0][0] if suffix == ".wav" else samples[0][1])
+        result["estimators"][name] = benchmark_estimator(
+            estimator, suffix, samples, measure_memory=measure_memory
+        )
+        print_summary(name, result["estimators"][name]["summary"])
+
+    if result_path is None:
+        result_path = f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=4, ensure_ascii=False)
+    rprint(f"saved {result_path}")
+    return result
+
+
+def print_summary(name, summary):
+    """print summary of an estimator"""
+    peak_memory = summary["peak_memory"]
+    memory_info = (
+        "" if peak_memory is None else f", peak {peak_memory / 2**20:7.2f}MB"
+    )
+    errors_info = ", ".join(
+        f"{error_name}: {error['mean']:6.2f}"
+        for error_name, error in summary["error"].items()
+    )
+    rprint(
+        f"[bold]{name:18}[/bold] {summary['mean_seconds'] * 1000:8.2f}ms/file"
+        + f", {summary['throughput']:7.2f} files/s{memory_info}"
+        + f"; mean {errors_info}"
+    )
+
+
+def compare_benchmarks(base_path, new_path):
+    """print summaries of two saved benchmark results side by side"""
+    with open(base_path, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = json.load(f)
+    for name, result in new["estimators"].items():
+        if name not in base["estimators"]:
+            continue
+        base_summary = base["estimators"][name]["summary"]
+        summary = result["summary"]
+        speedup = base_summary["mean_seconds"] / summary["mean_seconds"]
+        rprint(f"[bold]{name}[/bold]: x{speedup:.2f} speed")
+        for error_name, error in summary["error"].items():
+            base_mean = base_summary["error"][error_name]["mean"]
+            rprint(
+                f"  {error_name} mean: {base_mean:6.2f} -> {error['mean']:6.2f}"
+            )
+        if base_summary["peak_memory"] and summary["peak_memory"]:
+            rprint(
+                f"  peak memory: {base_summary['peak_memory'] / 2**20:.2f}MB"
+                + f" -> {summary['peak_memory'] / 2**20:.2f}MB"
+            )
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default="benchmark_fixtures",
+        help="Directory of the generated midi/wav fixtures",
+    )
+    parser.add_argument(
+        "--out", type=str, help="Output json path of the benchmark result"
+    )
+    parser.add_argument(
+        "--estimators",
+        nargs="+",
+        choices=list(ESTIMATORS),
+        help="Estimators to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "--bpms",
+        nargs="+",
+        type=int,
+        help="Tempos of the synthetic fixtures",
+    )
+    parser.add_argument(
+        "--no_memory",
+        action="store_true",
+        help="Skip the traced peak memory measurement",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASE", "NEW"),
+        help="Compare two saved benchmark results instead of running",
+    )
+    args = parser.parse_args()
+    if args.compare:
+        compare_benchmarks(*args.compare)
+        return
+    run_benchmark(
+        work_dir=args.work_dir,
+        result_path=args.out,
+        estimators=args.estimators,
+        bpms=args.bpms,
+        measure_memory=not args.no_memory,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,28 @@
 """Module for BPM estimating"""
 
+import json
 import multiprocessing as mp
+import os
+import pickle
 import random
+import sqlite3
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+from pathlib import Path
 
 import numpy as np
 import librosa
+import numba
 import pretty_midi
 import mido
+import soundfile
+import soxr
+import threadpoolctl
 
 from rich import print as rprint
 
+from midia import iter_merged_tracks, iter_track_events, smf_chunks
 from note import (
     DEFAULT_BPM,
     DEFAULT_TIME_SIGNATURE,
@@ -23,6 +36,330 @@ def bpm_estimator_librosa(audio_path):
     return tempo
 
 
+# soxr stream resamplers by (source rate, target rate), reused across files
+_RESAMPLERS = {}
+
+
+def _resampler(in_rate, out_rate):
+    key = (in_rate, out_rate)
+    if key in _RESAMPLERS:
+        _RESAMPLERS[key].clear()
+    else:
+        _RESAMPLERS[key] = soxr.ResampleStream(
+            in_rate, out_rate, 1, dtype="float32", quality="HQ"
+        )
+    return _RESAMPLERS[key]
+
+
+def _onset_flux(S_db, prev_db):
+    """median mel spectral flux, as librosa.beat.beat_track's onset_strength"""
+    S_db = np.concatenate((prev_db, S_db), axis=1)
+    return np.median(np.maximum(0.0, S_db[:, 1:] - S_db[:, :-1]), axis=0)
+
+
+def bpm_estimator_librosa_stream(
+    audio_path,
+    sr=22050,
+    hop_length=512,
+    n_fft=2048,
+    ac_size=8.0,
+    block_duration=10.0,
+    max_duration=None,
+    max_windows=None,
+):
+    """Function to estimate BPM from audio file by librosa in bounded memory
+
+    Same estimate as bpm_estimator_librosa (mel spectral flux onset
+    envelope, mean autocorrelation tempogram, log-normal tempo prior), but
+    the file is read and resampled block by block and only a running
+    tempogram sum is kept, so peak memory does not depend on the file
+    length. The dB floor (top_db) follows the running maximum instead of
+    the global one.
+
+    Args:
+        block_duration: seconds of audio decoded per window
+        max_duration: analyze at most this many seconds of audio
+        max_windows: analyze at most this many windows
+
+    Returns:
+        array([tempo]) like bpm_estimator_librosa
+    """
+    win_length = librosa.time_to_frames(
+        ac_size, sr=sr, hop_length=hop_length
+    ).item()
+    ac_window = librosa.filters.get_window("hann", win_length, fftbins=True)
+    tempogram_sum = np.zeros(win_length)
+    tempogram_num = 0
+    # half a window of silence centers the autocorrelation windows
+    odf_tail = np.zeros(win_length // 2)
+
+    def accumulate_tempogram(onset_env):
+        nonlocal odf_tail, tempogram_sum, tempogram_num
+        odf = np.concatenate((odf_tail, onset_env))
+        if len(odf) < win_length:
+            odf_tail = odf
+            return
+        odf_frame = librosa.util.frame(
+            odf, frame_length=win_length, hop_length=1
+        )
+        tempogram = librosa.util.normalize(
+            librosa.autocorrelate(odf_frame * ac_window[:, None], axis=0),
+            norm=np.inf,
+            axis=0,
+        )
+        tempogram_sum += tempogram.sum(axis=1)
+        tempogram_num += tempogram.shape[1]
+        odf_tail = odf[len(odf) - win_length + 1 :]
+
+    with soundfile.SoundFile(audio_path) as f:
+        resampler = None
+        if f.samplerate != sr:
+            resampler = _resampler(f.samplerate, sr)
+        block_size = int(block_duration * f.samplerate)
+        if max_duration is not None:
+            max_frames = int(max_duration * f.samplerate)
+        else:
+            max_frames = f.frames
+        # center padding of the first STFT frame
+        samples = np.zeros(n_fft // 2, dtype=np.float32)
+        prev_db = None
+        max_db = -np.inf
+        # framing compensation of librosa.onset.onset_strength, its lag
+        # compensation is the zero flux of the first frame against itself
+        accumulate_tempogram(np.zeros(n_fft // (2 * hop_length)))
+        window_num = 0
+        read_frames = 0
+        last = False
+        while not last:
+            y = f.read(
+                min(block_size, max_frames - read_frames),
+                dtype="float32",
+                always_2d=True,
+            ).mean(axis=1)
+            read_frames += len(y)
+            window_num += 1
+            last = (
+                not len(y)
+                or read_frames >= max_frames
+                or (max_windows is not None and window_num >= max_windows)
+            )
+            if resampler is not None:
+                y = resampler.resample_chunk(y, last=last)
+            samples = np.concatenate((samples, y))
+            if last:  # center padding of the last STFT frame
+                samples = np.concatenate(
+                    (samples, np.zeros(n_fft // 2, dtype=np.float32))
+                )
+            if len(samples) < n_fft:
+                continue
+            S = librosa.feature.melspectrogram(
+                y=samples,
+                sr=sr,
+                n_fft=n_fft,
+                hop_length=hop_length,
+                center=False,
+            )
+            samples = samples[S.shape[1] * hop_length :]
+            S_db = librosa.power_to_db(S, top_db=None)
+            max_db = max(max_db, S_db.max())
+            if prev_db is None:
+                prev_db = S_db[:, :1]
+            # the last frame is kept unclipped, so a rising floor doesn't
+            # turn the bands floored in the previous block into onsets
+            accumulate_tempogram(
+                _onset_flux(
+                    np.maximum(S_db, max_db - 80.0),
+                    np.maximum(prev_db, max_db - 80.0),
+                )
+            )
+            prev_db = S_db[:, -1:]
+    accumulate_tempogram(np.zeros(win_length // 2))
+
+    if not tempogram_sum.any():  # no onsets
+        return np.zeros(1)
+    return librosa.feature.tempo(
+        tg=(tempogram_sum / tempogram_num)[:, np.newaxis],
+        sr=sr,
+        hop_length=hop_length,
+    )
+
+
+TempoCandidates = namedtuple(
+    "TempoCandidates", ["bpms", "scores", "times", "local_bpms"]
+)
+
+
+def bpm_candidates_librosa(
+    audio_path,
+    k=3,
+    sr=22050,
+    hop_length=512,
+    ac_size=8.0,
+    start_bpm=120.0,
+    std_bpm=1.0,
+    max_tempo=320.0,
+):
+    """Function to estimate top-k BPM candidates and local tempo by librosa
+
+    The onset envelope and autocorrelation tempogram are computed once.
+    Candidates are the peaks of the mean tempogram weighted by the tempo
+    prior of librosa.feature.tempo, so bpms[0] is the bpm_estimator_librosa
+    estimate. The local tempo is the weighted tempogram peak of each frame.
+
+    Returns:
+        TempoCandidates(bpms, scores, times, local_bpms), scores are the
+        prior weighted peak strengths normalized to sum 1 over all peaks
+    """
+    y, sr = librosa.load(audio_path, sr=sr)
+    onset_env = librosa.onset.onset_strength(
+        y=y, sr=sr, hop_length=hop_length, aggregate=np.median
+    )
+    times = librosa.times_like(onset_env, sr=sr, hop_length=hop_length)
+    if not onset_env.any():  # no onsets
+        return TempoCandidates(
+            np.zeros(1), np.ones(1), times, np.zeros(len(times))
+        )
+    win_length = librosa.time_to_frames(
+        ac_size, sr=sr, hop_length=hop_length
+    ).item()
+    tempogram = librosa.feature.tempogram(
+        onset_envelope=onset_env,
+        sr=sr,
+        hop_length=hop_length,
+        win_length=win_length,
+    )
+    bpms = librosa.tempo_frequencies(win_length, sr=sr, hop_length=hop_length)
+    with np.errstate(divide="ignore"):
+        log_prior = (
+            -0.5 * ((np.log2(bpms) - np.log2(start_bpm)) / std_bpm) ** 2
+        )
+    log_prior[bpms >= max_tempo] = -np.inf
+    # same weighting as librosa.feature.tempo
+    local_bpms = bpms[
+        np.argmax(np.log1p(1e6 * tempogram) + log_prior[:, None], axis=0)
+    ]
+    weighted = np.log1p(1e6 * tempogram.mean(axis=1)) + log_prior
+    peaks = np.flatnonzero(librosa.util.localmax(weighted))
+    peaks = peaks[np.isfinite(weighted[peaks])]
+    peaks = peaks[np.argsort(weighted[peaks], kind="stable")[::-1]]
+    scores = np.exp(weighted[peaks] - weighted[peaks[0]])
+    scores /= scores.sum()
+    return TempoCandidates(bpms[peaks[:k]], scores[:k], times, local_bpms)
+
+
+def tempo_changes(candidates, tolerance=0.04, min_duration=2.0):
+    """Function to find tempo changes in the local tempo of TempoCandidates
+
+    A frame starts a new segment when its local tempo is off the running
+    mean tempo of the segment by more than tolerance (relative). Segments
+    shorter than min_duration seconds are merged into the previous one.
+
+    Returns:
+        list of (start second, mean bpm) of tempo segments
+    """
+    segments = []
+    bpm_sum = 0.0
+    begin = 0
+    for i, bpm in enumerate(candidates.local_bpms):
+        if i > begin:
+            mean_bpm = bpm_sum / (i - begin)
+            if abs(bpm - mean_bpm) <= tolerance * mean_bpm:
+                bpm_sum += bpm
+                continue
+            if (
+                candidates.times[i] - candidates.times[begin] >= min_duration
+                or not segments
+            ):
+                segments.append((float(candidates.times[begin]), mean_bpm))
+            begin = i
+            bpm_sum = 0.0
+        bpm_sum += bpm
+    if len(candidates.local_bpms) > begin:
+        mean_bpm = bpm_sum / (len(candidates.local_bpms) - begin)
+        segments.append((float(candidates.times[begin]), mean_bpm))
+    # merge neighbours with the same tempo
+    merged = []
+    for start, bpm in segments:
+        if merged and abs(merged[-1][1] - bpm) <= tolerance * bpm:
+            continue
+        merged.append((start, float(bpm)))
+    return merged
+
+
+BpmBatchResult = namedtuple(
+    "BpmBatchResult", ["path", "bpm", "seconds", "error"]
+)
+
+
+def _init_bpm_worker(threads_per_worker, worker_counter, pin_workers):
+    """limit BLAS/OpenMP/numba threads and pin the worker to its cores"""
+    for name in (
+        "OMP_NUM_THREADS",
+        "OPENBLAS_NUM_THREADS",
+        "MKL_NUM_THREADS",
+        "NUMBA_NUM_THREADS",
+    ):
+        os.environ[name] = str(threads_per_worker)
+    threadpoolctl.threadpool_limits(limits=threads_per_worker)
+    numba.set_num_threads(
+        min(threads_per_worker, numba.config.NUMBA_NUM_THREADS)
+    )
+    if pin_workers and hasattr(os, "sched_setaffinity"):
+        with worker_counter.get_lock():
+            worker_idx = worker_counter.value
+            worker_counter.value += 1
+        cores = sorted(os.sched_getaffinity(0))
+        begin = worker_idx * threads_per_worker % len(cores)
+        os.sched_setaffinity(
+            0, cores[begin : begin + threads_per_worker] or cores
+        )
+
+
+def _estimate_bpm_timed(task):
+    estimator, audio_path, estimator_kwargs = task
+    begin = time.perf_counter()
+    try:
+        bpm = float(estimator(audio_path, **estimator_kwargs)[0])
+        error = None
+    except (OSError, RuntimeError, ValueError) as e:
+        bpm = float("nan")
+        error = repr(e)
+    return BpmBatchResult(audio_path, bpm, time.perf_counter() - begin, error)
+
+
+def bpm_estimator_batch(
+    audio_paths,
+    processes=None,
+    threads_per_worker=1,
+    pin_workers=True,
+    estimator=bpm_estimator_librosa_stream,
+    **estimator_kwargs,
+):
+    """Function to estimate BPM of many audio files by a process pool
+
+    Each worker is limited to threads_per_worker BLAS/OpenMP/numba threads
+    and pinned to as many cores, so workers don't oversubscribe the
+    machine. Streaming resamplers are kept per worker and reused for files
+    with the same sample rate.
+
+    Returns:
+        BpmBatchResult(path, bpm, seconds, error) in input order; bpm is nan
+        and error is set if the file could not be estimated
+    """
+    audio_paths = list(audio_paths)
+    if processes is None:
+        processes = max(1, mp.cpu_count() // threads_per_worker)
+    worker_counter = mp.Value("i", 0)
+    tasks = [(estimator, path, estimator_kwargs) for path in audio_paths]
+    chunksize = max(1, len(tasks) // (processes * 16))
+    with mp.Pool(
+        processes,
+        initializer=_init_bpm_worker,
+        initargs=(threads_per_worker, worker_counter, pin_workers),
+    ) as p:
+        return p.map(_estimate_bpm_timed, tasks, chunksize=chunksize)
+
+
 def bpm_estimator_pretty_midi(midi_path):
     """Function to estimate BPM from mid file by pretty_midi"""
     midi_data = pretty_midi.PrettyMIDI(midi_path)
@@ -41,13 +378,12 @@ def _bpm_from_midi_format_0(mid_obj):
 def _bpm_from_midi_format_1(mid_obj):
     bpm = DEFAULT_BPM
     time_signature = DEFAULT_TIME_SIGNATURE
-    # convert midi format 1 to 0
-    merged_track = mido.merge_tracks(mid_obj.tracks)
     lyric_note_num = 0
     total_lyric_note_num = 0
     tempo_mean_numerator = 0
     first_tempo = True
-    for msg in merged_track:
+    # iterate midi format 1 as 0
+    for _, msg in iter_merged_tracks(mid_obj.tracks):
         if (
             msg.type == "note_on"
             or msg.type == "note_off"
@@ -84,109 +420,482 @@ def bpm_from_midi(mid_obj):
         raise NotImplementedError
 
 
+# kinds of the tempo-map events collected by _scan_track
+_TEMPO_EVENT = 0
+_TIME_SIGNATURE_EVENT = 1
+
+
+def _scan_track(track, stop_at_tempo=False):
+    """Walk a MTrk chunk without building messages
+
+    Only delta times, set_tempo/time_signature and the note_on, note_off,
+    lyrics events counted by _bpm_from_midi_format_1 are decoded; every
+    other payload is skipped by its length. Events are walked by
+    midia.iter_track_events, so a truncated track raises EOFError.
+
+    Returns:
+        note_ticks: absolute tick of every note_on/note_off/lyrics event
+        markers: (tick, note events before it in this track, kind, value)
+    """
+    note_ticks = []
+    markers = []
+    tick = 0
+    for delta, status, meta_type, pos, _ in iter_track_events(track):
+        tick += delta
+        if meta_type == 0x51:  # set_tempo
+            tempo = (track[pos] << 16) | (track[pos + 1] << 8) | track[pos + 2]
+            markers.append((tick, len(note_ticks), _TEMPO_EVENT, tempo))
+            if stop_at_tempo:
+                break
+        elif meta_type == 0x58:  # time_signature
+            markers.append(
+                (
+                    tick,
+                    len(note_ticks),
+                    _TIME_SIGNATURE_EVENT,
+                    (track[pos], 2 ** track[pos + 1]),
+                )
+            )
+        elif meta_type == 0x05 or status < 0xA0:  # lyrics, note_off/on
+            note_ticks.append(tick)
+    return note_ticks, markers
+
+
+def _bpm_from_smf_format_0(tracks):
+    time_signature = DEFAULT_TIME_SIGNATURE
+    _, markers = _scan_track(tracks[0], stop_at_tempo=True)
+    for _, _, kind, value in markers:
+        if kind == _TIME_SIGNATURE_EVENT:
+            time_signature = value
+        else:
+            return mido.tempo2bpm(value, time_signature=time_signature)
+
+
+def _bpm_from_smf_format_1(tracks):
+    """Same result as _bpm_from_midi_format_1 without merging the tracks
+
+    In mido.merge_tracks events are stably sorted by absolute tick, so an
+    event of track j precedes a tempo marker at tick t of track k if it
+    happens before t, or at t and j < k. The note events preceding each
+    marker are therefore counted with bisect over per-track tick lists.
+    """
+    scanned = [_scan_track(track) for track in tracks]
+    markers = sorted(
+        (tick, k, i, track_num, kind, value)
+        for k, (_, track_markers) in enumerate(scanned)
+        for i, (tick, track_num, kind, value) in enumerate(track_markers)
+    )
+
+    def note_num_before(tick, k, track_num):
+        note_num = track_num
+        for j, (note_ticks, _) in enumerate(scanned):
+            if j < k:
+                note_num += bisect_right(note_ticks, tick)
+            elif j > k:
+                note_num += bisect_left(note_ticks, tick)
+        return note_num
+
+    bpm = DEFAULT_BPM
+    time_signature = DEFAULT_TIME_SIGNATURE
+    tempo_mean_numerator = 0
+    total_lyric_note_num = 0
+    prev_note_num = 0
+    first_tempo = True
+    for tick, k, _, track_num, kind, value in markers:
+        if kind == _TIME_SIGNATURE_EVENT:
+            time_signature = value
+            continue
+        note_num = note_num_before(tick, k, track_num)
+        if first_tempo:
+            first_tempo = False
+        else:
+            tempo_mean_numerator += bpm * (note_num - prev_note_num)
+            total_lyric_note_num += note_num - prev_note_num
+        bpm = round(mido.tempo2bpm(value, time_signature=time_signature))
+        prev_note_num = note_num
+    note_num = sum(len(note_ticks) for note_ticks, _ in scanned)
+    tempo_mean_numerator += bpm * (note_num - prev_note_num)
+    total_lyric_note_num += note_num - prev_note_num
+    return tempo_mean_numerator / total_lyric_note_num
+
+
 def bpm_from_midi_file(midi_path):
-    """Function to extract BPM information from midi file"""
-    mid = mido.MidiFile(midi_path)
-    return bpm_from_midi(mid)
+    """Function to extract BPM information from midi file
 
+    Scans the raw SMF bytes instead of building a mido.MidiFile;
+    gives the same result as bpm_from_midi(mido.MidiFile(midi_path))"""
+    with open(midi_path, "rb") as f:
+        data = memoryview(f.read())
+    midi_type, _, tracks = smf_chunks(data)
+    if midi_type == 0:
+        return _bpm_from_smf_format_0(tracks)
+    elif midi_type == 1:
+        return _bpm_from_smf_format_1(tracks)
+    elif midi_type == 2:
+        raise NotImplementedError
+    else:
+        raise NotImplementedError
 
-def estimated_bpm_error(audio_path, midi_path):
-    """Function to calculate error of estimated bpm"""
+
+# correction factors applied to an estimated BPM, from /8 to *8
+BPM_CORRECTION_FACTORS = np.array([1 / 8, 1 / 4, 1 / 2, 1, 2, 4, 8])
+BPM_CORRECTION_NAMES = ("/8", "/4", "/2", "0", "*2", "*4", "*8")
+
+BPM_ERROR_DTYPE = np.dtype(
+    [
+        ("error", np.float64),
+        ("corrected_error_2", np.float64),
+        ("corrected_error_4", np.float64),
+        ("corrected_error_8", np.float64),
+        ("factor_errors", np.float64, (len(BPM_CORRECTION_FACTORS),)),
+        ("selected_error", np.int64),
+        ("factor", np.float64),
+        ("margin", np.float64),
+    ]
+)
+
+
+def bpm_error(estimated_bpm, bpm):
+    """Function to calculate errors of estimated bpm arrays
+
+    Every correction factor is applied at once by broadcasting.
+
+    Returns:
+        structured array of BPM_ERROR_DTYPE:
+            error: raw error
+            corrected_error_2/4/8: minimum error using factors up to /2..*2,
+                /4..*4, /8..*8
+            factor_errors: error of each of BPM_CORRECTION_FACTORS
+            selected_error: index of the factor with minimum error
+            factor: the selected factor
+            margin: gap between the best and second best factor errors
+    """
+    estimated_bpm = np.atleast_1d(np.asarray(estimated_bpm, dtype=np.float64))
+    bpm = np.atleast_1d(np.asarray(bpm, dtype=np.float64))
+    factor_errors = np.abs(
+        estimated_bpm[:, np.newaxis] * BPM_CORRECTION_FACTORS
+        - bpm[:, np.newaxis]
+    )
+    # factors are sorted, so /2..*2 is [2:5], /4..*4 is [1:6]
+    result = np.empty(len(factor_errors), dtype=BPM_ERROR_DTYPE)
+    result["error"] = factor_errors[:, 3]
+    result["corrected_error_2"] = factor_errors[:, 2:5].min(axis=1)
+    result["corrected_error_4"] = factor_errors[:, 1:6].min(axis=1)
+    result["corrected_error_8"] = factor_errors.min(axis=1)
+    result["factor_errors"] = factor_errors
+    result["selected_error"] = factor_errors.argmin(axis=1)
+    result["factor"] = BPM_CORRECTION_FACTORS[result["selected_error"]]
+    best_two = np.partition(factor_errors, 1, axis=1)
+    result["margin"] = best_two[:, 1] - best_two[:, 0]
+    return result
+
+
+def estimated_bpm_pair(audio_path, midi_path):
+    """Function to get (estimated bpm from audio, bpm from midi)"""
     if not midi_path.name.split(".")[0] == audio_path.name.split(".")[0]:
         raise ValueError
     estimated_bpm = bpm_estimator_librosa(audio_path)[0]
     bpm = bpm_from_midi_file(midi_path)
+    return estimated_bpm, bpm
 
-    error = abs(estimated_bpm - bpm)
-    corrected_overestimated_bpm_error_8 = abs(estimated_bpm / 8 - bpm)
-    corrected_overestimated_bpm_error_4 = abs(estimated_bpm / 4 - bpm)
-    corrected_overestimated_bpm_error_2 = abs(estimated_bpm / 2 - bpm)
-    corrected_underestimated_bpm_error_2 = abs(estimated_bpm * 2 - bpm)
-    corrected_underestimated_bpm_error_4 = abs(estimated_bpm * 4 - bpm)
-    corrected_underestimated_bpm_error_8 = abs(estimated_bpm * 8 - bpm)
-
-    selected_error = np.argmin(
-        [
-            corrected_overestimated_bpm_error_8,
-            corrected_overestimated_bpm_error_4,
-            corrected_overestimated_bpm_error_2,
-            error,
-            corrected_underestimated_bpm_error_2,
-            corrected_underestimated_bpm_error_4,
-            corrected_underestimated_bpm_error_8,
-        ]
-    )
 
-    corrected_error_2 = min(
-        error,
-        corrected_overestimated_bpm_error_2,
-        corrected_underestimated_bpm_error_2,
-    )
-    corrected_error_4 = min(
-        corrected_error_2,
-        corrected_overestimated_bpm_error_4,
-        corrected_underestimated_bpm_error_4,
-    )
-    corrected_error_8 = min(
-        corrected_error_4,
-        corrected_overestimated_bpm_error_8,
-        corrected_underestimated_bpm_error_8,
-    )
+def estimated_bpm_error(audio_path, midi_path):
+    """Function to calculate error of estimated bpm"""
+    error = bpm_error(*estimated_bpm_pair(audio_path, midi_path))[0]
     return (
-        error,
-        corrected_error_2,
-        corrected_error_4,
-        corrected_error_8,
-        selected_error,
+        error["error"],
+        error["corrected_error_2"],
+        error["corrected_error_4"],
+        error["corrected_error_8"],
+        error["selected_error"],
     )
 
 
-def statistics_estimated_bpm_error(path_obj, sample_num=None):
-    """Function to get statistics of errors of estimated bpm
-    by multiprocessing"""
+class BpmErrorStatistics:
+    """Running statistics of bpm_error results
 
-    with mp.Pool(mp.cpu_count()) as p:
-        samples = zip(
-            sorted(path_obj.rglob("*.wav"), key=lambda x: x.stem),
-            sorted(path_obj.rglob("*.mid"), key=lambda x: x.stem),
-        )
-        if sample_num:
-            samples = list(samples)
-            if sample_num < len(samples):
-                samples = random.sample(samples, k=sample_num)
-        error_array = np.array(p.starmap(estimated_bpm_error, samples))
-
-    rprint(
-        f"error(0); mean/std: {np.mean(error_array[:, 0]):5.2f}, "
-        + f"{np.std(error_array[:, 0]):5.2f}"
-    )
-    rprint(
-        f"error(2); mean/std: {np.mean(error_array[:, 1]):5.2f}, "
-        + f"{np.std(error_array[:, 1]):5.2f}"
-    )
-    rprint(
-        f"error(4); mean/std: {np.mean(error_array[:, 2]):5.2f}, "
-        + f"{np.std(error_array[:, 2]):5.2f}"
-    )
-    rprint(
-        f"error(8); mean/std: {np.mean(error_array[:, 3]):5.2f}, "
-        + f"{np.std(error_array[:, 3]):5.2f}"
-    )
+    Keeps sums instead of the results, so memory does not grow with the
+    number of evaluated files."""
 
-    selected_error_frequencies = np.bincount(
-        error_array[:, 4].astype(np.int64)
-    )
-    selected_error_frequencies = np.pad(
-        selected_error_frequencies,
-        (0, 7 - selected_error_frequencies.shape[0]),
-        "constant",
-        constant_values=(0, 0),
+    FIELDS = (
+        ("error", "error(0)"),
+        ("corrected_error_2", "error(2)"),
+        ("corrected_error_4", "error(4)"),
+        ("corrected_error_8", "error(8)"),
     )
-    rprint("selected error:")
-    rprint(f"  error(/8): {selected_error_frequencies[0]}")
-    rprint(f"  error(/4): {selected_error_frequencies[1]}")
-    rprint(f"  error(/2): {selected_error_frequencies[2]}")
-    rprint(f"  error(0) : {selected_error_frequencies[3]}")
-    rprint(f"  error(*2): {selected_error_frequencies[4]}")
-    rprint(f"  error(*4): {selected_error_frequencies[5]}")
-    rprint(f"  error(*8): {selected_error_frequencies[6]}")
+
+    def __init__(self):
+        self.num = 0
+        self.sums = np.zeros(len(self.FIELDS))
+        self.square_sums = np.zeros(len(self.FIELDS))
+        self.selected_error_frequencies = np.zeros(
+            len(BPM_CORRECTION_FACTORS), dtype=np.int64
+        )
+
+    def update(self, errors):
+        """add bpm_error result"""
+        self.num += len(errors)
+        for i, (field, _) in enumerate(self.FIELDS):
+            self.sums[i] += errors[field].sum()
+            self.square_sums[i] += np.square(errors[field]).sum()
+        self.selected_error_frequencies += np.bincount(
+            errors["selected_error"], minlength=len(BPM_CORRECTION_FACTORS)
+        )
+
+    def mean(self):
+        """mean of each field"""
+        return self.sums / self.num
+
+    def std(self):
+        """standard deviation of each field"""
+        mean = self.mean()
+        return np.sqrt(np.maximum(self.square_sums / self.num - mean**2, 0))
+
+    def print_progress(self, total_num):
+        """print a line of running statistics"""
+        errors_info = ", ".join(
+            f"{name}: {mean:5.2f}"
+            for (_, name), mean in zip(self.FIELDS, self.mean())
+        )
+        rprint(f"[{self.num}/{total_num}] mean {errors_info}")
+
+    def print(self):
+        """print statistics"""
+        for (_, name), mean, std in zip(self.FIELDS, self.mean(), self.std()):
+            rprint(f"{name}; mean/std: {mean:5.2f}, {std:5.2f}")
+
+        rprint("selected error:")
+        for name, frequency in zip(
+            BPM_CORRECTION_NAMES, self.selected_error_frequencies
+        ):
+            label = f"error({name})"
+            rprint(f"  {label:9}: {frequency}")
+
+
+def print_bpm_error_statistics(errors):
+    """Function to print statistics of bpm_error result"""
+    statistics = BpmErrorStatistics()
+    statistics.update(errors)
+    statistics.print()
+
+
+def pair_dataset_files(path_obj, suffixes=(".wav", ".mid")):
+    """Function to pair files of a dataset tree by stem in one walk
+
+    Returns:
+        pairs: tuples of paths with the suffixes, sorted by stem
+        orphans: paths whose stem misses a suffix or is duplicated
+    """
+    files = defaultdict(dict)
+    duplicated_stems = set()
+    orphans = []
+    for dir_path, _, file_names in os.walk(path_obj):
+        for file_name in file_names:
+            stem, suffix = os.path.splitext(file_name)
+            if suffix not in suffixes:
+                continue
+            path = Path(dir_path) / file_name
+            if suffix in files[stem]:
+                duplicated_stems.add(stem)
+                orphans.append(path)
+            else:
+                files[stem][suffix] = path
+    pairs = []
+    for stem in sorted(files):
+        if stem not in duplicated_stems and len(files[stem]) == len(suffixes):
+            pairs.append(tuple(files[stem][suffix] for suffix in suffixes))
+        else:
+            orphans.extend(files[stem].values())
+    return pairs, orphans
+
+
+class BpmCache:
+    """Persistent cache of BPM estimation results
+
+    Results are stored in SQLite and keyed by estimator name, path, file
+    size, mtime and estimator parameters, so a changed file or parameter
+    is a miss. Every result is committed when it is stored, so a killed
+    run resumes from where it stopped. When the pickled results take more
+    than max_bytes, the least recently used ones are evicted in one batch
+    down to evict_ratio of max_bytes.
+    """
+
+    _WHERE = "estimator=? AND path=? AND size=? AND mtime=? AND params=?"
+
+    def __init__(
+        self, db_path="bpm_cache.sqlite3", max_bytes=64 << 20, evict_ratio=0.9
+    ):
+        self.max_bytes = max_bytes
+        self.evict_ratio = evict_ratio
+        self.con = sqlite3.connect(db_path, isolation_level=None)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "estimator TEXT, path TEXT, size INTEGER, mtime INTEGER, "
+            "params TEXT, value BLOB, last_used REAL, "
+            "PRIMARY KEY (estimator, path, size, mtime, params))"
+        )
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used "
+            "ON results (last_used)"
+        )
+        self.nbytes = self._stored_bytes()
+
+    def _stored_bytes(self):
+        (nbytes,) = self.con.execute(
+            "SELECT COALESCE(SUM(LENGTH(value)), 0) FROM results"
+        ).fetchone()
+        return nbytes
+
+    def close(self):
+        """close"""
+        self.con.close()
+
+    def _key(self, estimator, path, params):
+        stat = os.stat(path)
+        return (
+            estimator.__name__,
+            os.path.abspath(path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            json.dumps(params, sort_keys=True),
+        )
+
+    def lookup(self, estimator, path, **params):
+        """return (found, value) of cached estimator(path, **params)"""
+        key = self._key(estimator, path, params)
+        row = self.con.execute(
+            f"SELECT value FROM results WHERE {self._WHERE}", key
+        ).fetchone()
+        if row is None:
+            return False, None
+        self.con.execute(
+            f"UPDATE results SET last_used=? WHERE {self._WHERE}",
+            (time.time(), *key),
+        )
+        return True, pickle.loads(row[0])
+
+    def store(self, estimator, path, value, **params):
+        """store result of estimator(path, **params)"""
+        key = self._key(estimator, path, params)
+        value = pickle.dumps(value)
+        row = self.con.execute(
+            f"SELECT LENGTH(value) FROM results WHERE {self._WHERE}", key
+        ).fetchone()
+        self.con.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*key, value, time.time()),
+        )
+        self.nbytes += len(value) - (0 if row is None else row[0])
+        if self.nbytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """evict least recently used results down to the evict_ratio"""
+        # other processes may share the database, so recount first
+        self.nbytes = self._stored_bytes()
+        target = self.max_bytes * self.evict_ratio
+        rowids = []
+        freed = 0
+        for rowid, nbytes in self.con.execute(
+            "SELECT rowid, LENGTH(value) FROM results ORDER BY last_used"
+        ):
+            if self.nbytes - freed <= target:
+                break
+            rowids.append((rowid,))
+            freed += nbytes
+        self.con.executemany("DELETE FROM results WHERE rowid=?", rowids)
+        self.nbytes -= freed
+
+    def cached(self, estimator, path, **params):
+        """estimator(path, **params) through the cache"""
+        found, value = self.lookup(estimator, path, **params)
+        if not found:
+            value = estimator(path, **params)
+            self.store(estimator, path, value, **params)
+        return value
+
+
+def _estimated_bpm_pair(sample):
+    return sample, estimated_bpm_pair(*sample)
+
+
+def statistics_estimated_bpm_error(
+    path_obj,
+    sample_num=None,
+    cache_path=None,
+    report_interval=5.0,
+    batch_size=256,
+):
+    """Function to get statistics of errors of estimated bpm
+    by multiprocessing
+
+    wav/mid files are paired by stem in one walk and unpaired files are
+    reported. Results stream into BpmErrorStatistics as workers finish,
+    and running statistics are printed every report_interval seconds.
+    With cache_path, estimated BPMs are read from and stored to a BpmCache
+    so only new or modified files are processed."""
+
+    samples, orphans = pair_dataset_files(path_obj)
+    if orphans:
+        rprint(f"{len(orphans)} unpaired files:")
+        for orphan in orphans:
+            rprint(f"  {orphan}")
+    if sample_num and sample_num < len(samples):
+        samples = random.sample(samples, k=sample_num)
+
+    statistics = BpmErrorStatistics()
+    bpm_pairs = []
+
+    def aggregate(bpm_pair=None, flush=False):
+        if bpm_pair is not None:
+            bpm_pairs.append(bpm_pair)
+        if bpm_pairs and (flush or len(bpm_pairs) >= batch_size):
+            pairs = np.array(bpm_pairs)
+            statistics.update(bpm_error(pairs[:, 0], pairs[:, 1]))
+            bpm_pairs.clear()
+
+    cache = None if cache_path is None else BpmCache(cache_path)
+    uncached_samples = []
+    for audio_path, midi_path in samples:
+        if cache is not None:
+            found_estimated, estimated_bpm = cache.lookup(
+                bpm_estimator_librosa, audio_path
+            )
+            found_bpm, bpm = cache.lookup(bpm_from_midi_file, midi_path)
+            if found_estimated and found_bpm:
+                aggregate((estimated_bpm[0], bpm))
+                continue
+        uncached_samples.append((audio_path, midi_path))
+    aggregate(flush=True)
+
+    if uncached_samples:
+        processes = mp.cpu_count()
+        # small chunks give the first results early and balance the load
+        chunksize = max(1, min(8, len(uncached_samples) // (processes * 16)))
+        reported_time = time.monotonic()
+        with mp.Pool(processes) as p:
+            for (audio_path, midi_path), (
+                estimated_bpm,
+                bpm,
+            ) in p.imap_unordered(
+                _estimated_bpm_pair, uncached_samples, chunksize=chunksize
+            ):
+                if cache is not None:
+                    cache.store(
+                        bpm_estimator_librosa,
+                        audio_path,
+                        np.array([estimated_bpm]),
+                    )
+                    cache.store(bpm_from_midi_file, midi_path, bpm)
+                aggregate((estimated_bpm, bpm))
+                if time.monotonic() - reported_time > report_interval:
+                    aggregate(flush=True)
+                    statistics.print_progress(len(samples))
+                    reported_time = time.monotonic()
+        aggregate(flush=True)
+    if cache is not None:
+        cache.close()
+
+    statistics.print()
+    return statistics
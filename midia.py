@@ -1,31 +1,41 @@
 """midia"""
 
 import sys
-from collections import defaultdict
+import codecs
+import contextlib
+import heapq
+from collections import OrderedDict, defaultdict, namedtuple
 import string
 import json
 from pathlib import Path
 import os
+import multiprocessing as mp
+import queue
+import struct
+import time
+import wave
+import zipfile
 
 import pretty_midi
 import numpy as np
 import mido as md
-from mido import MidiFile, Message, MetaMessage
+from mido import MidiFile, MidiTrack, Message, MetaMessage
+from mido.midifiles.meta import build_meta_message
 
-from pydub import AudioSegment
-from pydub.generators import Sine
 from rich import print as rprint
 from rich.console import Console
 from rich.panel import Panel
+from rich.rule import Rule
 
 from note import (
     Note,
-    Note_all,
-    Rest_all,
     COLOR,
     DEFAULT_TEMPO,
     DEFAULT_TIME_SIGNATURE,
     DEFAULT_PPQN,
+    closest_duration,
+    closest_durations,
+    duration_table,
 )
 
 
@@ -39,54 +49,1142 @@ def beat2tick(beat, ppqn):
     return int(beat * ppqn)
 
 
-def midi2wav(mid_obj, wav_path, bpm):
-    """Function to convert midi to wav
-    ref: https://gist.github.com/jiaaro/339df443b005e12d6c2a"""
+# number of data bytes following each status byte (None: undefined status)
+STATUS_DATA_LENGTH = (
+    [None] * 0x80
+    + [
+        2 if 0x80 <= status < 0xC0 or 0xE0 <= status < 0xF0 else 1
+        for status in range(0x80, 0xF0)
+    ]
+    + [None, 1, 2, 1, None, None, 0, None, 0, None, 0, 0, 0, None, 0, None]
+)
 
-    def note_to_freq(note, concert_A=440.0):
-        """
-        http://en.wikipedia.org/wiki/MIDI_Tuning_Standard#Frequency_values
+
+def read_variable_int(data, pos):
+    """read a variable length quantity, returns (value, next pos)"""
+    value = 0
+    while True:
+        if pos >= len(data):
+            raise EOFError
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def iter_track_events(track):
+    """Walk the events of a MTrk chunk like mido without building messages
+
+    As in mido, every status byte but a meta event's sets the running
+    status, and a running sysex status consumes the byte that follows the
+    delta. A truncated event raises EOFError.
+
+    Yields:
+        (delta, status, meta type or None, payload pos, payload length),
+        the payload of a channel event is its data bytes
+    """
+    pos = 0
+    end = len(track)
+    last_status = None
+    while pos < end:
+        delta, pos = read_variable_int(track, pos)
+        if pos >= end:
+            raise EOFError
+        status = track[pos]
+        pos += 1
+        if status < 0x80:  # running status
+            if last_status is None:
+                raise OSError("running status without last_status")
+            status = last_status
+            if status < 0xF0:  # the byte is the first data byte
+                pos -= 1
+        elif status != 0xFF:  # meta messages don't set running status
+            last_status = status
+        meta_type = None
+        if status == 0xFF:
+            if pos >= end:
+                raise EOFError
+            meta_type = track[pos]
+            length, pos = read_variable_int(track, pos + 1)
+        elif status == 0xF0 or status == 0xF7:
+            length, pos = read_variable_int(track, pos)
+        else:
+            length = STATUS_DATA_LENGTH[status]
+            if length is None:
+                raise OSError(f"undefined status byte 0x{status:02x}")
+        if pos + length > end:
+            raise EOFError
+        if (
+            status < 0xF0
+            and length
+            and (track[pos] > 127 or track[pos + length - 1] > 127)
+        ):
+            raise OSError("data byte must be in range 0..127")
+        yield delta, status, meta_type, pos, length
+        pos += length
+
+
+def smf_header(data):
+    """Read (type, track num, ticks_per_beat, header size) of raw SMF bytes
+
+    Only the first 14 bytes are needed.
+    """
+    if bytes(data[:4]) != b"MThd":
+        raise OSError("MThd not found. Probably not a MIDI file")
+    header_size = int.from_bytes(data[4:8], "big")
+    if header_size < 6 or len(data) < 14:
+        raise EOFError
+    midi_type, num_tracks, ppqn = struct.unpack(">hhh", data[8:14])
+    return midi_type, num_tracks, ppqn, header_size
+
+
+def smf_chunks(data):
+    """Split raw SMF bytes into (type, ticks_per_beat, track memoryviews)"""
+    midi_type, num_tracks, ppqn, header_size = smf_header(data)
+    if len(data) < 8 + header_size:
+        raise EOFError
+    tracks = []
+    pos = 8 + header_size
+    while len(tracks) < num_tracks and pos + 8 <= len(data):
+        name = bytes(data[pos : pos + 4])
+        size = int.from_bytes(data[pos + 4 : pos + 8], "big")
+        pos += 8
+        if name == b"MTrk":  # alien chunks are skipped
+            tracks.append(data[pos : pos + size])
+        pos += size
+    if len(tracks) < num_tracks:
+        raise EOFError
+    return midi_type, ppqn, tracks
+
+
+def grid_ticks(unit, ppqn):
+    """grid size in ticks of a note unit, "32" or triplet "16t"
+
+    Triplet grid ticks may be fractional.
+    """
+    triplet = unit.endswith("t")
+    base = unit[:-1] if triplet else unit
+    if not any(base == n.value.name_short.split("/")[-1] for n in Note):
+        raise ValueError(f"unknown quantization unit: {unit}")
+    grid = 4 / int(base) * ppqn
+    return grid * 2 / 3 if triplet else grid
+
+
+def _abs_time_track(track, track_idx):
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        yield tick, track_idx, msg
+
+
+def iter_merged_tracks(tracks):
+    """Lazily merge tracks into (absolute tick, msg) in mido.merge_tracks order
+
+    Messages are ordered by absolute tick, then by track, then by position
+    in the track, with a heap over one pending message per track, so the
+    tracks are never copied. Like mido.merge_tracks, end_of_track messages
+    are replaced by a single one at the end."""
+    end_tick = 0
+    for tick, _, msg in heapq.merge(
+        *(_abs_time_track(track, i) for i, track in enumerate(tracks)),
+        key=lambda item: item[:2],
+    ):
+        end_tick = tick
+        if msg.type != "end_of_track":
+            yield tick, msg
+    yield end_tick, MetaMessage("end_of_track", time=0)
+
+
+def merge_tracks_inplace(tracks):
+    """merge tracks into one MidiTrack like mido.merge_tracks
+
+    The messages are not copied: their time is rewritten to the delta in
+    the merged track, so the source tracks must not be used afterwards."""
+    merged_track = MidiTrack()
+    prev_tick = 0
+    for tick, msg in iter_merged_tracks(tracks):
+        msg.time = tick - prev_tick
+        prev_tick = tick
+        merged_track.append(msg)
+    return merged_track
+
+
+def detect_encoding(payloads, encodings=("utf-8", "cp949")):
+    """Detect one encoding for text payloads of a track
+
+    Each encoding gets one incremental decoder fed with every payload;
+    confidence is the fraction of payloads it decodes without error. The
+    first encoding with the best confidence wins, so an earlier encoding
+    is preferred when several decode everything (e.g. plain ASCII).
+
+    Returns:
+        (encoding, confidence)
+    """
+    best_encoding, best_confidence = encodings[0], -1.0
+    for encoding in dict.fromkeys(encodings):
+        decoder = codecs.getincrementaldecoder(encoding)(errors="strict")
+        decoded = 0
+        for payload in payloads:
+            try:
+                decoder.decode(payload, final=True)
+            except UnicodeDecodeError:
+                decoder.reset()
+                continue
+            decoded += 1
+        confidence = decoded / len(payloads) if payloads else 1.0
+        if confidence > best_confidence:
+            best_encoding, best_confidence = encoding, confidence
+        if confidence == 1.0:
+            break
+    return best_encoding, best_confidence
+
+
+class TempoMap:
+    """Tempo segments of a midi file as cumulative tick/second arrays
+
+    ticks[i] is the absolute tick where tempos[i] starts and seconds[i] is
+    the time at that tick, so whole arrays of ticks convert to seconds (and
+    back) with np.searchsorted instead of a mido.tick2second per message.
+    """
+
+    def __init__(self, tempo_changes, ppqn):
+        """tempo_changes: (absolute tick, tempo) sorted by tick"""
+        ticks = [0]
+        tempos = [DEFAULT_TEMPO]
+        for tick, tempo in tempo_changes:
+            if tick == ticks[-1]:  # the last tempo at a tick wins
+                tempos[-1] = tempo
+            else:
+                ticks.append(tick)
+                tempos.append(tempo)
+        self.ppqn = ppqn
+        self.ticks = np.array(ticks, dtype=np.int64)
+        self.tempos = np.array(tempos, dtype=np.int64)
+        # seconds per tick of each segment
+        self.scales = self.tempos * 1e-6 / ppqn
+        self.seconds = np.concatenate(
+            ([0.0], np.cumsum(np.diff(self.ticks) * self.scales[:-1]))
+        )
+
+    @classmethod
+    def from_event_tables(cls, tables, ppqn):
+        """collect set_tempo events of all MidiEventTable"""
+        return cls.from_track_changes(
+            [table.tempo_changes() for table in tables], ppqn
+        )
+
+    @classmethod
+    def from_track_changes(cls, track_changes, ppqn):
+        """merge (absolute tick, tempo) lists of each track"""
+        changes = [change for changes in track_changes for change in changes]
+        # stable sort keeps track order of tempos at the same tick
+        changes.sort(key=lambda change: change[0])
+        return cls(changes, ppqn)
+
+    def _segment(self, ticks):
+        return np.searchsorted(self.ticks, ticks, side="right") - 1
+
+    def tempo_at(self, ticks):
+        """tempo in effect at absolute ticks"""
+        return self.tempos[self._segment(ticks)]
+
+    def tick2second(self, ticks):
+        """absolute ticks to absolute seconds"""
+        ticks = np.asarray(ticks)
+        idx = self._segment(ticks)
+        return self.seconds[idx] + (ticks - self.ticks[idx]) * self.scales[idx]
+
+    def second2tick(self, seconds):
+        """absolute seconds to absolute (rounded) ticks"""
+        seconds = np.asarray(seconds, dtype=np.float64)
+        idx = np.searchsorted(self.seconds, seconds, side="right") - 1
+        ticks = (
+            self.ticks[idx] + (seconds - self.seconds[idx]) / self.scales[idx]
+        )
+        return np.round(ticks).astype(np.int64)
+
+
+# type codes of MidiEventTable, channel messages first, then meta messages
+EVENT_TYPES = (
+    "note_off",
+    "note_on",
+    "polytouch",
+    "control_change",
+    "program_change",
+    "aftertouch",
+    "pitchwheel",
+    "sysex",
+    "sequence_number",
+    "text",
+    "copyright",
+    "track_name",
+    "instrument_name",
+    "lyrics",
+    "marker",
+    "cue_marker",
+    "device_name",
+    "channel_prefix",
+    "midi_port",
+    "end_of_track",
+    "set_tempo",
+    "smpte_offset",
+    "time_signature",
+    "key_signature",
+    "sequencer_specific",
+    "rest",
+    "measure",
+    "unknown_meta",
+)
+EVENT_CODE = {event_type: code for code, event_type in enumerate(EVENT_TYPES)}
+_META_TYPE_BYTES = {
+    "sequence_number": 0x00,
+    "text": 0x01,
+    "copyright": 0x02,
+    "track_name": 0x03,
+    "instrument_name": 0x04,
+    "lyrics": 0x05,
+    "marker": 0x06,
+    "cue_marker": 0x07,
+    "device_name": 0x09,
+    "channel_prefix": 0x20,
+    "midi_port": 0x21,
+    "end_of_track": 0x2F,
+    "set_tempo": 0x51,
+    "smpte_offset": 0x54,
+    "time_signature": 0x58,
+    "key_signature": 0x59,
+    "sequencer_specific": 0x7F,
+    # custom meta messages of the analyzer, see test.test_custom_msg
+    "rest": 0xA0,
+    "measure": 0xA1,
+}
+_META_CODE = {
+    type_byte: EVENT_CODE[event_type]
+    for event_type, type_byte in _META_TYPE_BYTES.items()
+}
+
+EVENT_DTYPE = np.dtype(
+    [
+        ("tick", np.int64),  # absolute tick
+        ("delta", np.int64),  # delta tick, msg.time
+        ("type", np.uint8),  # index of EVENT_TYPES
+        ("channel", np.int8),
+        ("note", np.int16),  # note, control or program
+        ("velocity", np.int16),  # velocity or value of polytouch, cc, ...
+        ("value", np.int64),  # pitch, tempo or type byte of unknown_meta
+        ("offset", np.int64),  # payload of meta/sysex in the text buffer
+        ("length", np.int32),
+    ]
+)
+
+
+class MidiEventTable:
+    """Columnar events of a midi track
+
+    events is a structured array of EVENT_DTYPE, one row per message, and
+    meta/sysex payloads (lyrics, text, ...) are slices of one shared bytes
+    buffer, so a track is a few arrays instead of a list of mido messages.
+    """
+
+    def __init__(self, events, buffer=b""):
+        self.events = events
+        self.buffer = bytes(buffer)
+
+    def __len__(self):
+        return len(self.events)
+
+    def __getitem__(self, field):
+        return self.events[field]
+
+    @classmethod
+    def from_bytes(cls, track):
+        """parse a MTrk chunk (bytes or memoryview) into a table"""
+        columns = {name: [] for name in EVENT_DTYPE.names}
+        buffer = bytearray()
+        tick = 0
+        for delta, status, meta_type, pos, length in iter_track_events(track):
+            tick += delta
+            channel = note = velocity = value = offset = 0
+            data = track[pos : pos + length]
+            if status == 0xFF:
+                code = _META_CODE.get(meta_type, EVENT_CODE["unknown_meta"])
+                if code == EVENT_CODE["set_tempo"]:
+                    value = int.from_bytes(data[:3], "big")
+                elif code == EVENT_CODE["unknown_meta"]:
+                    value = meta_type
+                offset = len(buffer)
+                buffer += data
+            elif status == 0xF0 or status == 0xF7:
+                code = EVENT_CODE["sysex"]
+                if len(data) and data[0] == 0xF0:
+                    data = data[1:]
+                if len(data) and data[-1] == 0xF7:
+                    data = data[:-1]
+                offset = len(buffer)
+                length = len(data)
+                buffer += data
+            else:
+                code = (status >> 4) - 8
+                channel = status & 0x0F
+                length = 0
+                if code == EVENT_CODE["pitchwheel"]:
+                    value = (data[0] | (data[1] << 7)) - 8192
+                elif code == EVENT_CODE["aftertouch"]:
+                    velocity = data[0]
+                else:
+                    note = data[0]
+                    velocity = data[1] if len(data) == 2 else 0
+            columns["tick"].append(tick)
+            columns["delta"].append(delta)
+            columns["type"].append(code)
+            columns["channel"].append(channel)
+            columns["note"].append(note)
+            columns["velocity"].append(velocity)
+            columns["value"].append(value)
+            columns["offset"].append(offset)
+            columns["length"].append(length)
+        return cls._from_columns(columns, buffer)
+
+    @classmethod
+    def from_track(cls, track):
+        """convert a mido track into a table"""
+        columns = {name: [] for name in EVENT_DTYPE.names}
+        buffer = bytearray()
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            code, channel, note, velocity, value, data = event_fields(msg)
+            offset = length = 0
+            if data is not None:
+                offset = len(buffer)
+                length = len(data)
+                buffer += data
+            columns["tick"].append(tick)
+            columns["delta"].append(msg.time)
+            columns["type"].append(code)
+            columns["channel"].append(channel)
+            columns["note"].append(note)
+            columns["velocity"].append(velocity)
+            columns["value"].append(value)
+            columns["offset"].append(offset)
+            columns["length"].append(length)
+        return cls._from_columns(columns, buffer)
+
+    @classmethod
+    def _from_columns(cls, columns, buffer):
+        events = np.empty(len(columns["tick"]), dtype=EVENT_DTYPE)
+        for name, column in columns.items():
+            events[name] = column
+        return cls(events, buffer)
+
+    @classmethod
+    def merge(cls, tables):
+        """merge tables into one like merge_tracks_inplace
+
+        Events are stably sorted by tick, so ties keep track order and
+        position in the track; end_of_track events are replaced by one at
+        the end.
         """
-        return (2.0 ** ((note - 69) / 12.0)) * concert_A
+        if not tables:
+            tables = [cls(np.empty(0, dtype=EVENT_DTYPE))]
+        events = np.concatenate([table.events for table in tables])
+        # shift payload offsets into the concatenated buffer
+        buffer_offsets = np.cumsum([0] + [len(t.buffer) for t in tables])
+        events["offset"] += np.repeat(
+            buffer_offsets[:-1], [len(table) for table in tables]
+        )
+        buffer = b"".join(table.buffer for table in tables)
+        end_tick = int(events["tick"].max()) if len(events) else 0
+        order = np.argsort(events["tick"], kind="stable")
+        events = events[order]
+        events = events[events["type"] != EVENT_CODE["end_of_track"]]
+        end_of_track = np.zeros(1, dtype=EVENT_DTYPE)
+        end_of_track["tick"] = end_tick
+        end_of_track["type"] = EVENT_CODE["end_of_track"]
+        end_of_track["offset"] = len(buffer)
+        events = np.concatenate((events, end_of_track))
+        events["delta"] = np.diff(events["tick"], prepend=0)
+        return cls(events, buffer)
+
+    @property
+    def name(self):
+        """name of the first track_name event, like MidiTrack.name"""
+        idx = np.flatnonzero(self.events["type"] == EVENT_CODE["track_name"])
+        if not len(idx):
+            return ""
+        return self.payload(idx[0]).decode("latin1")
+
+    def payload(self, idx):
+        """meta/sysex payload bytes of an event"""
+        event = self.events[idx]
+        offset = int(event["offset"])
+        return self.buffer[offset : offset + int(event["length"])]
+
+    def mask(self, *event_types):
+        """boolean mask of events of the given types"""
+        return np.isin(
+            self.events["type"], [EVENT_CODE[t] for t in event_types]
+        )
+
+    def tempo_changes(self):
+        """(absolute tick, tempo) of set_tempo events"""
+        is_tempo = self.mask("set_tempo")
+        return list(
+            zip(
+                self.events["tick"][is_tempo].tolist(),
+                self.events["value"][is_tempo].tolist(),
+            )
+        )
+
+    def with_ticks(self, ticks):
+        """copy of the table with new absolute ticks and rebuilt deltas"""
+        events = self.events.copy()
+        events["tick"] = ticks
+        events["delta"] = np.diff(ticks, prepend=0)
+        return MidiEventTable(events, self.buffer)
+
+    def message(self, idx):
+        """rebuild the mido message of an event"""
+        event = self.events[idx]
+        event_type = EVENT_TYPES[event["type"]]
+        time = int(event["delta"])
+        if event["type"] >= EVENT_CODE["sequence_number"]:
+            if event_type == "unknown_meta":
+                type_byte = int(event["value"])
+            else:
+                type_byte = _META_TYPE_BYTES[event_type]
+            return build_meta_message(
+                type_byte, list(self.payload(idx)), delta=time
+            )
+        if event_type == "sysex":
+            return Message("sysex", data=self.payload(idx), time=time)
+        channel = int(event["channel"])
+        note = int(event["note"])
+        velocity = int(event["velocity"])
+        match event_type:
+            case "note_on" | "note_off":
+                kwargs = {"note": note, "velocity": velocity}
+            case "polytouch":
+                kwargs = {"note": note, "value": velocity}
+            case "control_change":
+                kwargs = {"control": note, "value": velocity}
+            case "program_change":
+                kwargs = {"program": note}
+            case "aftertouch":
+                kwargs = {"value": velocity}
+            case "pitchwheel":
+                kwargs = {"pitch": int(event["value"])}
+        return Message(event_type, channel=channel, time=time, **kwargs)
+
+    def to_track(self):
+        """rebuild the mido track"""
+        return MidiTrack(self.message(i) for i in range(len(self.events)))
+
+
+_TEXT_EVENT_TYPES = ("text", "track_name", "lyrics")
+
+
+def event_fields(msg):
+    """fields of a mido message as a MidiEventTable row
+
+    Returns:
+        (type code, channel, note, velocity, value, payload bytes or None)
+    """
+    channel = note = velocity = value = 0
+    data = None
+    code = EVENT_CODE.get(msg.type, EVENT_CODE["unknown_meta"])
+    if msg.is_meta:
+        if msg.type == "unknown_meta":
+            value = msg.type_byte
+            data = bytes(msg.data)
+        else:
+            raw = msg.bin()
+            _, pos = read_variable_int(raw, 2)
+            data = raw[pos:]
+            if msg.type == "set_tempo":
+                value = msg.tempo
+            elif code == EVENT_CODE["unknown_meta"]:
+                value = raw[1]
+    elif msg.type == "sysex":
+        data = bytes(msg.data)
+    else:
+        channel = msg.channel
+        match msg.type:
+            case "note_on" | "note_off":
+                note, velocity = msg.note, msg.velocity
+            case "polytouch":
+                note, velocity = msg.note, msg.value
+            case "control_change":
+                note, velocity = msg.control, msg.value
+            case "program_change":
+                note = msg.program
+            case "aftertouch":
+                velocity = msg.value
+            case "pitchwheel":
+                value = msg.pitch
+    return code, channel, note, velocity, value, data
+
+
+def scan_tempo_changes(track):
+    """(absolute tick, tempo) of set_tempo events of a MTrk chunk
+
+    Other events are only walked over, not parsed into a MidiEventTable.
+    """
+    changes = []
+    tick = 0
+    for delta, _, meta_type, pos, length in iter_track_events(track):
+        tick += delta
+        if meta_type == 0x51:  # set_tempo
+            tempo = int.from_bytes(track[pos : pos + min(length, 3)], "big")
+            changes.append((tick, tempo))
+    return changes
+
 
-    output = AudioSegment.silent(mid_obj.length * 1000.0)
+def read_event_tables(midi_path):
+    """Parse a midi file into MidiEventTable of each track
+
+    Returns:
+        (midi type, ticks per beat, list of MidiEventTable)
+    """
+    with open(midi_path, "rb") as f:
+        data = memoryview(f.read())
+    midi_type, ppqn, tracks = smf_chunks(data)
+    return midi_type, ppqn, [MidiEventTable.from_bytes(t) for t in tracks]
+
+
+def utf8_stdout():
+    """reconfigure stdout to utf-8 to print lyrics, if it is not yet"""
+    encoding = getattr(sys.stdout, "encoding", None) or ""
+    if encoding.lower().replace("-", "") != "utf8" and hasattr(
+        sys.stdout, "reconfigure"
+    ):
+        sys.stdout.reconfigure(encoding="utf-8")
 
-    def ticks_to_ms(ticks):
-        tick_ms = (60000.0 / bpm) / mid_obj.ticks_per_beat
-        return ticks * tick_ms
 
-    for track in mid_obj.tracks:
-        # position of rendering in ms
-        current_pos = 0.0
+# rendering of midi2wav, sample by sample like the pydub Sine renderer
+SAMPLE_RATE = 44100
+SILENT_SAMPLE_RATE = 11025  # rate of AudioSegment.silent before overlays
+TONE_VOLUME = -20  # dBFS
+FADE_IN_MS = 30
+FADE_OUT_MS = 100
+NOTE_GAP_MS = 50  # cut from the end of every note
+FADE_MIN_GAIN = -120  # dB
+
+
+def note_to_freq(note, concert_A=440.0):
+    """
+    http://en.wikipedia.org/wiki/MIDI_Tuning_Standard#Frequency_values
+    """
+    return (2.0 ** ((note - 69) / 12.0)) * concert_A
+
+
+def _db_to_float(db):
+    return 10 ** (db / 20)
+
+
+def _ms_to_frames(ms, sample_rate=SAMPLE_RATE):
+    return int(ms * (sample_rate / 1000.0))
+
+
+def _duration_frames(ms, sample_rate=SAMPLE_RATE):
+    """sample count of a generated tone like pydub SignalGenerator"""
+    return int(sample_rate * (ms / 1000.0))
+
+
+def _frames_to_ms(frames, sample_rate=SAMPLE_RATE):
+    return round(1000 * (frames / sample_rate))
+
+
+def _segment(samples, start_ms, end_ms):
+    """samples[start_ms:end_ms] like AudioSegment slicing"""
+    length = _frames_to_ms(len(samples))
+    positions = []
+    for ms in (min(start_ms, length), min(end_ms, length)):
+        if ms < 0:
+            ms = length - abs(ms)
+        positions.append(_ms_to_frames(ms))
+    begin, end = positions
+    segment = samples[begin:end]
+    missing = end - begin - len(segment)
+    if missing > 0 and len(segment):  # padded with silence
+        segment = np.concatenate((segment, np.zeros(missing)))
+    return segment
+
+
+def _mul(samples, factor):
+    """audioop.mul of 16 bit samples, rounding towards minus infinity"""
+    return np.floor(np.clip(samples * factor, -32768, 32767))
+
+
+def _fade(samples, to_gain=0, from_gain=0, start=None, end=None):
+    """AudioSegment.fade over [start, end) ms of one of the fade lengths"""
+    if start is None:
+        start = end - (FADE_OUT_MS if to_gain else FADE_IN_MS)
+    else:
+        end = start + (FADE_OUT_MS if to_gain else FADE_IN_MS)
+    from_power = _db_to_float(from_gain)
+    gain_delta = _db_to_float(to_gain) - from_power
+    # one gain step per sample, samples are picked like get_frame
+    start_frame = start * (SAMPLE_RATE / 1000.0)
+    fade_frames = end * (SAMPLE_RATE / 1000.0) - start_frame
+    steps = np.arange(int(fade_frames))
+    idx = np.trunc(start_frame + steps).astype(np.int64)
+    num = len(samples)
+    picked = ((idx >= 0) & (idx < num)) | ((idx >= -num) & (idx <= -2))
+    fade = _mul(
+        samples[idx[picked] % max(num, 1)],
+        from_power + (gain_delta / fade_frames) * steps[picked],
+    )
+    before = _segment(samples, 0, start)
+    if from_gain:
+        before = _mul(before, from_power)
+    after = _segment(samples, end, _frames_to_ms(num))
+    if to_gain:
+        after = _mul(after, _db_to_float(to_gain))
+    return np.concatenate((before, fade, after))
+
+
+def render_tone(note, frame_num):
+    """sine tone of a note with fade out and fade in, as 16 bit values
+
+    Same samples as pydub Sine(...).to_audio_segment(volume=TONE_VOLUME)
+    .fade_out(FADE_OUT_MS).fade_in(FADE_IN_MS) of frame_num samples.
+    """
+    sine_of = (note_to_freq(note) * 2 * np.pi) / SAMPLE_RATE
+    tone = np.trunc(
+        np.sin(sine_of * np.arange(frame_num))
+        * 32767
+        * _db_to_float(TONE_VOLUME)
+    )
+    tone = _fade(tone, to_gain=FADE_MIN_GAIN, end=_frames_to_ms(frame_num))
+    return _fade(tone, from_gain=FADE_MIN_GAIN, start=0)
+
+
+class ToneCache:
+    """LRU cache of render_tone by (note, frame num) under a memory cap
+
+    A tone depends only on its note and its duration quantized to samples,
+    so tones are rendered once and shared across notes and files. Cached
+    tones are read-only float32 arrays. The cache belongs to one process,
+    so max_bytes is a cap per worker.
+    """
+
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.tones = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.tones)
+
+    def get(self, note, frame_num):
+        """tone of render_tone(note, frame_num)"""
+        key = (note, frame_num)
+        tone = self.tones.get(key)
+        if tone is not None:
+            self.tones.move_to_end(key)
+            return tone
+        tone = render_tone(note, frame_num).astype(np.float32)
+        tone.flags.writeable = False
+        if tone.nbytes <= self.max_bytes:
+            self.tones[key] = tone
+            self.nbytes += tone.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.tones.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return tone
+
+    def clear(self):
+        """drop every tone"""
+        self.tones.clear()
+        self.nbytes = 0
+
+
+# tones shared by every rendering of the process
+TONE_CACHE = ToneCache()
+
+
+def note_events(tables, ppqn, tempo_map=None, bpm=None):
+    """(start ms, duration ms, note) of the notes of tracks to render
+
+    Times follow tempo_map, or one bpm if given. Like the pydub renderer, a
+    note_on restarts a sounding note and a note_off without note_on is
+    skipped.
+    """
+    starts, durations, notes = [], [], []
+    for table in tables:
+        if bpm is None:
+            poses = tempo_map.tick2second(table["tick"]) * 1000.0
+        else:
+            tick_ms = (60000.0 / bpm) / ppqn
+            poses = np.cumsum(table["delta"] * tick_ms)
+        is_note = table.mask("note_on", "note_off")
         current_notes = defaultdict(dict)
+        for event_type, channel, note, pos in zip(
+            table["type"][is_note].tolist(),
+            table["channel"][is_note].tolist(),
+            table["note"][is_note].tolist(),
+            poses[is_note].tolist(),
+        ):
+            if event_type == EVENT_CODE["note_on"]:
+                current_notes[channel][note] = pos
+            elif note in current_notes[channel]:
+                start_pos = current_notes[channel].pop(note)
+                starts.append(start_pos)
+                durations.append(pos - start_pos)
+                notes.append(note)
+    return starts, durations, notes
+
+
+def _render_size(length, has_notes=True):
+    """(frame num, sample rate, length ms) of the buffer of render_notes"""
+    silent_frames = int(SILENT_SAMPLE_RATE * ((length * 1000.0) / 1000.0))
+    if not has_notes:
+        return silent_frames, SILENT_SAMPLE_RATE, None
+    length_ms = _frames_to_ms(max(4 * silent_frames - 3, 0))
+    return _ms_to_frames(length_ms), SAMPLE_RATE, length_ms
+
+
+def render_notes(
+    starts, durations, notes, length, tone_cache=TONE_CACHE, frames=None
+):
+    """mix tones of notes into one preallocated float32 buffer
 
-        for msg in track:
-            current_pos += ticks_to_ms(msg.time)
-            if msg.type == "note_on":
-                current_notes[msg.channel][msg.note] = (current_pos, msg)
-            if msg.type == "note_off":
-                start_pos, _ = current_notes[msg.channel].pop(msg.note)
-                duration = current_pos - start_pos
-                signal_generator = Sine(note_to_freq(msg.note))
-                rendered = (
-                    signal_generator.to_audio_segment(
-                        duration=duration - 50, volume=-20
-                    )
-                    .fade_out(100)
-                    .fade_in(30)
-                )
-                output = output.overlay(rendered, start_pos)
-    output.export(wav_path, format="wav")
+    The buffer has the length of the pydub renderer: AudioSegment.silent of
+    length seconds, resampled to SAMPLE_RATE by the first overlay. Tones
+    come from tone_cache, or are rendered for each note if it is None.
+    If frames is (begin, end), only that frame range of the buffer is
+    rendered, so blocks of a long file can be rendered apart and joined.
 
+    Returns:
+        (buffer, sample rate)
+    """
+    frame_num, sample_rate, length_ms = _render_size(length, bool(notes))
+    block_begin, block_end = (0, frame_num) if frames is None else frames
+    block_end = min(block_end, frame_num)
+    buffer = np.zeros(max(block_end - block_begin, 0), dtype=np.float32)
+    if not notes:
+        return buffer, sample_rate
+    for start, duration, note in zip(starts, durations, notes):
+        begin = _ms_to_frames(min(start, length_ms))
+        tone_frames = _duration_frames(max(duration - NOTE_GAP_MS, 0))
+        if begin >= block_end:
+            continue
+        if tone_cache is None:
+            tone = render_tone(note, tone_frames)
+        else:
+            tone = tone_cache.get(note, tone_frames)
+        lo = max(begin, block_begin)
+        hi = min(begin + len(tone), block_end)
+        if lo >= hi:
+            continue
+        buffer[lo - block_begin : hi - block_begin] += tone[
+            lo - begin : hi - begin
+        ]
+    return buffer, sample_rate
+
+
+def write_wav(wav_path, buffer, sample_rate, block_size=1 << 16):
+    """write a float buffer of 16 bit values as wav, block by block"""
+    with wave.open(str(wav_path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.setnframes(len(buffer))
+        for begin in range(0, len(buffer), block_size):
+            block = buffer[begin : begin + block_size]
+            f.writeframesraw(
+                np.clip(block, -32768, 32767).astype("<i2").tobytes()
+            )
+
+
+def midi2wav(mid_obj, wav_path, bpm=None):
+    """Function to convert midi to wav
+
+    Every note is a sine tone with fades, timed by the tempo map of the file
+    or by one bpm if given.
+    ref: https://gist.github.com/jiaaro/339df443b005e12d6c2a"""
+    tables = [MidiEventTable.from_track(track) for track in mid_obj.tracks]
+    tempo_map = TempoMap.from_event_tables(tables, mid_obj.ticks_per_beat)
+    buffer, sample_rate = render_notes(
+        *note_events(
+            tables, mid_obj.ticks_per_beat, tempo_map=tempo_map, bpm=bpm
+        ),
+        length=mid_obj.length,
+    )
+    write_wav(wav_path, buffer, sample_rate)
+
+
+def midifile2wav(midi_path, wav_path, bpm=None):
+    """midifile2wav(midi_path, wav_path, bpm=None)"""
+    ma = MidiAnalyzer(midi_path)
+    buffer, sample_rate = render_notes(
+        *note_events(
+            ma.event_tables, ma.ppqn, tempo_map=ma.tempo_map, bpm=bpm
+        ),
+        length=ma.length,
+    )
+    write_wav(wav_path, buffer, sample_rate)
+
+
+def write_wav_atomic(wav_path, buffer, sample_rate):
+    """write_wav to a temporary file next to wav_path, then rename it"""
+    wav_path = Path(wav_path)
+    wav_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = wav_path.with_name(f".{wav_path.name}.{os.getpid()}.tmp")
+    try:
+        write_wav(tmp_path, buffer, sample_rate)
+        os.replace(tmp_path, wav_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+RenderBatchResult = namedtuple(
+    "RenderBatchResult",
+    ["midi_path", "wav_path", "length", "seconds", "error"],
+)
 
-def midifile2wav(midi_path, wav_path, bpm):
-    """midifile2wav(midi_path, wav_path, bpm)"""
-    mid = MidiFile(midi_path)
-    midi2wav(mid, wav_path, bpm)
+
+def render_jobs(input_path, out_dir):
+    """(midi path, wav path) pairs of a directory or a manifest file
+
+    A directory is searched for *.mid recursively and wav files mirror its
+    layout under out_dir. Each line of a manifest is a midi path, optionally
+    followed by a tab and the wav path; otherwise the wav is written to
+    out_dir by the midi file name.
+    """
+    input_path, out_dir = Path(input_path), Path(out_dir)
+    if input_path.is_dir():
+        return [
+            (
+                midi_path,
+                out_dir
+                / midi_path.relative_to(input_path).with_suffix(".wav"),
+            )
+            for midi_path in sorted(input_path.rglob("*.mid"))
+        ]
+    jobs = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = [field.strip() for field in line.split("\t")]
+            if not fields[0]:
+                continue
+            midi_path = Path(fields[0])
+            if len(fields) > 1 and fields[1]:
+                wav_path = Path(fields[1])
+            else:
+                wav_path = out_dir / midi_path.with_suffix(".wav").name
+            jobs.append((midi_path, wav_path))
+    return jobs
+
+
+def _render_file(midi_path, wav_path, bpm, block_seconds):
+    """render a file to its wav, or return its notes to render in blocks
+
+    Returns:
+        (length, notes or None, seconds, error)
+    """
+    begin = time.perf_counter()
+    length = 0.0
+    try:
+        ma = MidiAnalyzer(midi_path)
+        length = ma.length
+        notes = note_events(
+            ma.event_tables, ma.ppqn, tempo_map=ma.tempo_map, bpm=bpm
+        )
+        if notes[2] and length > block_seconds:
+            notes = tuple(np.asarray(column) for column in notes)
+            return length, notes, time.perf_counter() - begin, None
+        write_wav_atomic(wav_path, *render_notes(*notes, length=length))
+    except (OSError, EOFError, ValueError, IndexError, struct.error) as e:
+        return length, None, time.perf_counter() - begin, repr(e)
+    return length, None, time.perf_counter() - begin, None
+
+
+def _init_render_worker(tone_cache_bytes):
+    """cap the tone cache of a worker of midifile2wav_batch"""
+    TONE_CACHE.max_bytes = tone_cache_bytes
+
+
+def _render_block(notes, length, frames):
+    """render a frame range of notes returned by _render_file"""
+    begin = time.perf_counter()
+    buffer, sample_rate = render_notes(
+        *(column.tolist() for column in notes), length=length, frames=frames
+    )
+    return buffer, sample_rate, time.perf_counter() - begin
+
+
+def midifile2wav_batch(
+    jobs,
+    processes=None,
+    block_seconds=60.0,
+    bpm=None,
+    tone_cache_bytes=256 << 20,
+):
+    """Function to render many (midi path, wav path) by a process pool
+
+    Files are scheduled largest first, so a long file doesn't start last
+    and keep one worker busy after the others are done. Each file is
+    parsed once by a worker; the notes of a file longer than block_seconds
+    come back to be rendered as frame ranges by several workers, which are
+    joined in the parent. A wav is written to a temporary file and renamed,
+    so an interrupted batch never leaves a truncated wav. A file that
+    fails to parse or render is reported by its error and doesn't stop the
+    rest of the batch. tone_cache_bytes is split among the workers, so
+    their tone caches together stay under it.
+
+    Returns:
+        RenderBatchResult(midi_path, wav_path, length, seconds, error) in
+        input order; seconds is the render time summed over blocks
+    """
+    jobs = [(Path(midi_path), Path(wav_path)) for midi_path, wav_path in jobs]
+    sizes = []
+    for midi_path, _ in jobs:
+        try:
+            sizes.append(os.path.getsize(midi_path))
+        except OSError:  # reported by the worker
+            sizes.append(0)
+    results = [None] * len(jobs)
+    lengths = [0.0] * len(jobs)
+    seconds = [0.0] * len(jobs)
+    blocks = defaultdict(dict)
+    remaining = defaultdict(int)
+    errors = {}
+    block_frames = max(1, int(block_seconds * SAMPLE_RATE))
+    done = queue.SimpleQueue()
+    if processes is None:
+        processes = mp.cpu_count()
+    with mp.Pool(
+        processes, _init_render_worker, (tone_cache_bytes // processes,)
+    ) as p:
+
+        def submit(func, args, key):
+            p.apply_async(
+                func,
+                args,
+                callback=lambda result: done.put((key, result)),
+                error_callback=lambda e: done.put((key, e)),
+            )
+
+        for i in sorted(range(len(jobs)), key=sizes.__getitem__, reverse=True):
+            submit(_render_file, (*jobs[i], bpm, block_seconds), (i, None))
+        pending = len(jobs)
+        while pending:
+            (i, frames), result = done.get()
+            pending -= 1
+            midi_path, wav_path = jobs[i]
+            if frames is None:
+                if isinstance(result, BaseException):  # not caught by a worker
+                    result = lengths[i], None, seconds[i], repr(result)
+                lengths[i], notes, seconds[i], error = result
+                if notes is None:
+                    results[i] = RenderBatchResult(
+                        midi_path, wav_path, lengths[i], seconds[i], error
+                    )
+                    continue
+                for begin in range(
+                    0, _render_size(lengths[i])[0], block_frames
+                ):
+                    frames = (begin, begin + block_frames)
+                    submit(
+                        _render_block, (notes, lengths[i], frames), (i, frames)
+                    )
+                    remaining[i] += 1
+                pending += remaining[i]
+                continue
+            if isinstance(result, BaseException):
+                errors.setdefault(i, repr(result))
+            else:
+                buffer, sample_rate, task_seconds = result
+                blocks[i][frames] = buffer
+                seconds[i] += task_seconds
+            remaining[i] -= 1
+            if remaining[i]:
+                continue
+            error = errors.pop(i, None)
+            begin = time.perf_counter()
+            try:
+                if error is None:
+                    write_wav_atomic(
+                        wav_path,
+                        np.concatenate(
+                            [blocks[i][frames] for frames in sorted(blocks[i])]
+                        ),
+                        sample_rate,
+                    )
+            except OSError as e:
+                error = repr(e)
+            seconds[i] += time.perf_counter() - begin
+            del blocks[i]
+            results[i] = RenderBatchResult(
+                midi_path, wav_path, lengths[i], seconds[i], error
+            )
+    return results
+
+
+def print_render_summary(results, wall_seconds):
+    """print throughput and real-time factor of midifile2wav_batch"""
+    rendered = [result for result in results if result.error is None]
+    audio_seconds = sum(result.length for result in rendered)
+    for result in results:
+        if result.error is not None:
+            rprint(f"[red]failed[/red] {result.midi_path}: {result.error}")
+    rprint(
+        f"{len(rendered)}/{len(results)} files in {wall_seconds:.2f}s"
+        + f", {len(rendered) / wall_seconds:7.2f} files/s"
+        + f", {audio_seconds:.1f}s of audio"
+        + f", real-time factor {wall_seconds / max(audio_seconds, 1e-9):.4f}"
+        + f" (x{audio_seconds / wall_seconds:.1f} real time)"
+    )
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "input",
+        type=str,
+        help="Directory of midi files, or manifest of midi[<TAB>wav] lines",
+    )
+    parser.add_argument(
+        "out_dir", type=str, help="Output directory of the wav files"
+    )
+    parser.add_argument(
+        "--processes", type=int, help="Number of workers (default: all CPUs)"
+    )
+    parser.add_argument(
+        "--block_seconds",
+        type=float,
+        default=60.0,
+        help="Files longer than this are rendered in blocks in parallel",
+    )
+    parser.add_argument(
+        "--bpm", type=float, help="Render by one bpm instead of the tempo map"
+    )
+    args = parser.parse_args()
+    begin = time.perf_counter()
+    results = midifile2wav_batch(
+        render_jobs(args.input, args.out_dir),
+        processes=args.processes,
+        block_seconds=args.block_seconds,
+        bpm=args.bpm,
+    )
+    print_render_summary(results, time.perf_counter() - begin)
 
 
 class MidiAnalyzer:
-    """Class for analysis midi file"""
+    """Class for analysis midi file
+
+    The file is split into track chunks on construction. The tempo map is
+    scanned from set_tempo events only, the event table of a track is
+    parsed when the track is first touched, MidiTrackAnalyzer are built
+    per track on access and the mido MidiFile is loaded only if self.mid
+    is used.
+    """
 
     def __init__(
         self,
@@ -94,67 +1192,205 @@ class MidiAnalyzer:
         convert_1_to_0=False,
         encoding="utf-8",
     ):
-        sys.stdout.reconfigure(encoding="utf-8")  # printing encoding
         self.midi_path = midi_path
-        self.mid = MidiFile(self.midi_path)
-        self.ppqn = self.mid.ticks_per_beat
         self.convert_1_to_0 = convert_1_to_0
+        self.encoding = encoding
+        with open(midi_path, "rb") as f:
+            self.type, self.ppqn, self._tracks = smf_chunks(
+                memoryview(f.read())
+            )
+        self.merge_tracks = self.type == 1 and self.convert_1_to_0
+        self.track_num = 1 if self.merge_tracks else len(self._tracks)
+        self._event_tables = [None] * self.track_num
+        self._track_analyzers = [None] * self.track_num
+        self._mid = None
+        self._tempo_map = None
+        self._length = None
+
+    def event_table(self, i):
+        """MidiEventTable of track i, parsed on first access"""
+        if self._event_tables[i] is None:
+            if self.merge_tracks:
+                self._event_tables[i] = MidiEventTable.merge(
+                    [MidiEventTable.from_bytes(t) for t in self._tracks]
+                )
+            else:
+                self._event_tables[i] = MidiEventTable.from_bytes(
+                    self._tracks[i]
+                )
+        return self._event_tables[i]
+
+    @property
+    def event_tables(self):
+        """MidiEventTable of every track"""
+        return [self.event_table(i) for i in range(self.track_num)]
+
+    @property
+    def tempo_map(self):
+        """TempoMap of all tracks
+
+        Tracks not parsed yet are only scanned for their set_tempo events.
+        """
+        if self._tempo_map is None:
+            tables = self._current_event_tables()
+            if self.merge_tracks and tables[0] is None:
+                track_changes = [scan_tempo_changes(t) for t in self._tracks]
+            else:
+                track_changes = [
+                    (
+                        scan_tempo_changes(self._tracks[i])
+                        if table is None
+                        else table.tempo_changes()
+                    )
+                    for i, table in enumerate(tables)
+                ]
+            self._tempo_map = TempoMap.from_track_changes(
+                track_changes, self.ppqn
+            )
+        return self._tempo_map
 
-        if self.mid.type == 1 and self.convert_1_to_0:
-            self.mid.tracks = [md.merge_tracks(self.mid.tracks)]
+    def _current_event_tables(self):
+        """event tables with modifications of built track analyzers
 
-        self.track_analyzers = [
-            MidiTrackAnalyzer(
+        Tracks not parsed yet are None.
+        """
+        return [
+            self._event_tables[i] if analyzer is None else analyzer.events
+            for i, analyzer in enumerate(self._track_analyzers)
+        ]
+
+    def track_analyzer(self, i):
+        """MidiTrackAnalyzer of track i, built on first access"""
+        if self._track_analyzers[i] is None:
+            if self._mid is not None:  # share the tracks of loaded mid
+                track = self._mid.tracks[i]
+            else:
+                track = self.event_table(i)
+            self._track_analyzers[i] = MidiTrackAnalyzer(
                 track,
                 self.ppqn,
-                encoding=encoding,
-                convert_1_to_0=convert_1_to_0,
+                encoding=self.encoding,
+                convert_1_to_0=self.convert_1_to_0,
+                tempo_map=self.tempo_map,
             )
-            for track in self.mid.tracks
-        ]
+        return self._track_analyzers[i]
+
+    @property
+    def track_analyzers(self):
+        """MidiTrackAnalyzer of every track"""
+        return [self.track_analyzer(i) for i in range(self.track_num)]
+
+    @property
+    def mid(self):
+        """mido MidiFile, loaded on first access
+
+        Tracks of already built track analyzers replace the loaded ones.
+        """
+        if self._mid is None:
+            self._mid = MidiFile(self.midi_path)
+            if self.merge_tracks:
+                self._mid.tracks = [merge_tracks_inplace(self._mid.tracks)]
+            for i, analyzer in enumerate(self._track_analyzers):
+                if analyzer is not None:
+                    self._mid.tracks[i] = analyzer.track
+        return self._mid
+
+    @property
+    def length(self):
+        """playback time in seconds like MidiFile.length, cached"""
+        if self._length is None:
+            if self.type == 2:
+                raise ValueError(
+                    "impossible to compute length"
+                    + " for type 2 (asynchronous) file"
+                )
+            events = MidiEventTable.merge(
+                [
+                    self.event_table(i) if table is None else table
+                    for i, table in enumerate(self._current_event_tables())
+                ]
+            )
+            is_tempo = events["type"] == EVENT_CODE["set_tempo"]
+            # tempo of each delta time, set before the message
+            tempos = np.where(is_tempo, events["value"], 0)
+            tempo_idx = np.maximum.accumulate(
+                np.where(is_tempo, np.arange(len(events)), -1)
+            )
+            prev_tempo_idx = np.concatenate(([-1], tempo_idx[:-1]))
+            tempos = np.where(
+                prev_tempo_idx < 0, DEFAULT_TEMPO, tempos[prev_tempo_idx]
+            )
+            # same float operations and summation order as mido, which
+            # gives int 0 if every delta is 0
+            scales = tempos * 1e-6 / self.ppqn
+            deltas = events["delta"] > 0
+            self._length = sum(
+                (events["delta"][deltas] * scales[deltas]).tolist()
+            )
+        return self._length
+
+    def _update_tempo_map(self):
+        """rebuild tempo map after track times are modified"""
+        self._tempo_map = None
+        self._length = None
+        for track_analyzer in self._track_analyzers:
+            if track_analyzer is not None:
+                track_analyzer.tempo_map = self.tempo_map
 
     def quantization(self, unit="32"):
         """quantization"""
         for i, track_analyzer in enumerate(self.track_analyzers):
-            self.mid.tracks[i] = track_analyzer.quantization(unit=unit)
+            track = track_analyzer.quantization(unit=unit)
+            if self._mid is not None:
+                self._mid.tracks[i] = track
+        self._update_tempo_map()
 
     def split_space_note(self, remove_silence_threshold=0.3):
         """split_space_note"""
         for i, track_analyzer in enumerate(self.track_analyzers):
-            self.mid.tracks[i] = track_analyzer.split_space_note(
+            track = track_analyzer.split_space_note(
                 remove_silence_threshold=remove_silence_threshold
             )
+            if self._mid is not None:
+                self._mid.tracks[i] = track
+        self._update_tempo_map()
+
+    def normalize(self, remove_silence_threshold=0.3, unit="32"):
+        """split_space_note and quantization in one stage"""
+        for i, track_analyzer in enumerate(self.track_analyzers):
+            track_analyzer.normalize(
+                remove_silence_threshold=remove_silence_threshold, unit=unit
+            )
+            if self._mid is not None:
+                self._mid.tracks[i] = track_analyzer.track
+        self._update_tempo_map()
 
     def slice_chunks_time(self, chunks_time):
         """slice_chunks_time"""
-        if self.mid.type == 1 and not self.convert_1_to_0:
+        if self.type == 1 and not self.convert_1_to_0:
             raise RuntimeError
-        result = []
-        for chunk_time in chunks_time:
-            begin, end = chunk_time
-            result.append(
-                self.track_analyzers[0].slice(begin / 100, end / 100)
-            )
-        return result
+        return self.track_analyzer(0).slice_chunks(
+            [(begin / 100, end / 100) for begin, end in chunks_time]
+        )
 
     def slice_slience(self):
         """slice_slience"""
-        if self.mid.type == 1 and not self.convert_1_to_0:
+        if self.type == 1 and not self.convert_1_to_0:
             raise RuntimeError
-        return self.track_analyzers[0].slice_slience()
+        return self.track_analyzer(0).slice_slience()
 
     def slice(self, begin, end):
         """slice"""
-        if self.mid.type == 1 and not self.convert_1_to_0:
+        if self.type == 1 and not self.convert_1_to_0:
             raise RuntimeError
-        return self.track_analyzers[0].slice(begin, end)
+        return self.track_analyzer(0).slice(begin, end)
 
-    def to_json(self, dir_path=None):
-        """to_json"""
-        if self.mid.type == 1 and not self.convert_1_to_0:
+    def to_json(self, dir_path=None, writer="json"):
+        """to_json, writer is a key of NOTE_WRITERS"""
+        if self.type == 1 and not self.convert_1_to_0:
             raise RuntimeError
-        return self.track_analyzers[0].to_json(
-            file_path=self.mid.filename, dir_path=dir_path
+        return self.track_analyzer(0).to_json(
+            file_path=self.midi_path, dir_path=dir_path, writer=writer
         )
 
     def analysis(
@@ -165,57 +1401,211 @@ class MidiAnalyzer:
         blind_lyric=True,
         track_list=None,
         blind_note_info=False,
+        render=True,
+        console=None,
+        pager=False,
+        jsonl=None,
     ):
-        """method to analysis"""
+        """method to analysis
 
+        With render=False nothing is printed and the TrackRecords of the
+        analyzed tracks are returned. With jsonl (path or text file), the
+        records of each track are written there one event per line as soon
+        as they are computed, instead of rendered, and None is returned.
+        Rendering goes through one console, paged if pager is set.
+        """
+        track_records = []
         if track_bound is None:
             track_bound = float("inf")
+        if jsonl is not None:
+            with contextlib.ExitStack() as stack:
+                if isinstance(jsonl, (str, os.PathLike)):
+                    jsonl = stack.enter_context(
+                        open(jsonl, "w", encoding="utf-8")
+                    )
+                for i in range(self.track_num):
+                    track_analyzer = self.track_analyzer(i)
+                    if track_list is None or track_analyzer.name in track_list:
+                        track_analyzer.write_jsonl(
+                            track_analyzer.records(track_bound=track_bound),
+                            jsonl,
+                            track=i,
+                        )
+            return None
+        if not render:
+            for track_analyzer in self.track_analyzers:
+                if track_list is None or track_analyzer.name in track_list:
+                    track_records.append(
+                        track_analyzer.records(track_bound=track_bound)
+                    )
+            return track_records
+
+        if console is None:
+            utf8_stdout()
+            console = Console()
+        with console.pager(styles=True) if pager else contextlib.nullcontext():
+            self._render(
+                console,
+                track_records,
+                track_bound=track_bound,
+                blind_note=blind_note,
+                blind_time=blind_time,
+                blind_lyric=blind_lyric,
+                track_list=track_list,
+                blind_note_info=blind_note_info,
+            )
+        return track_records
+
+    def _render(
+        self, console, track_records, track_bound, track_list, **kwargs
+    ):
+        """print header and tracks to console"""
         # meta information of midi file
         header_style = "black on white blink"
         header_info = "\n".join(
             [
-                f"[{header_style}]mid file type: {self.mid.type}",
+                f"[{header_style}]mid file type: {self.type}",
                 f"ticks per beat: {self.ppqn}",
-                f"total duration: {self.mid.length}[/{header_style}]",
+                f"total duration: {self.length}[/{header_style}]",
             ]
         )
         header_panel = Panel(
             header_info,
             title="[MIDI File Header]",
-            subtitle=f"{self.mid.filename}",
+            subtitle=f"{self.midi_path}",
             style=f"{header_style}",
             border_style=f"{header_style}",
         )
-        rprint(header_panel)
+        console.print(header_panel)
 
         for i, track_analyzer in enumerate(self.track_analyzers):
-            console = Console()
             console.rule(
                 "[#ffffff on #4707a8]" + f'Track {i}: "{track_analyzer.name}"'
                 f"[/#ffffff on #4707a8]",
                 style="#ffffff on #4707a8",
             )
             if track_list is None or track_analyzer.name in track_list:
-                track_analyzer.analysis(
-                    track_bound=track_bound,
-                    blind_note=blind_note,
-                    blind_time=blind_time,
-                    blind_lyric=blind_lyric,
-                    blind_note_info=blind_note_info,
+                track_records.append(
+                    track_analyzer.analysis(
+                        track_bound=track_bound, console=console, **kwargs
+                    )
                 )
 
 
 class MidiTrackAnalyzer:
     """Class for analysis midi track"""
 
-    def __init__(self, track, ppqn, encoding="utf-8", convert_1_to_0=False):
-        self.track = track
+    def __init__(
+        self,
+        track,
+        ppqn,
+        encoding="utf-8",
+        convert_1_to_0=False,
+        tempo_map=None,
+    ):
+        if isinstance(track, MidiEventTable):
+            self._track = None
+            self._events = track
+        else:
+            self._track = track
+            self._events = None
         self.name = track.name
         self.ppqn = ppqn
         self.encoding = encoding
+        self._text_encoding = None
         self.convert_1_to_0 = convert_1_to_0
+        # without the file's tempo map, only tempos of this track are known
+        self.own_tempo_map = tempo_map is None
+        self.tempo_map = tempo_map
+        self._update_tempo_map()
         self._init_values()
 
+    @property
+    def track(self):
+        """mido track, rebuilt from the event table if needed"""
+        if self._track is None:
+            self._track = self._events.to_track()
+        return self._track
+
+    @track.setter
+    def track(self, track):
+        self._track = track
+        self._events = None
+
+    @property
+    def events(self):
+        """MidiEventTable of the track, rebuilt after the track changes"""
+        if self._events is None:
+            self._events = MidiEventTable.from_track(self._track)
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self._events = events
+        self._track = None
+
+    def _update_tempo_map(self):
+        if self.own_tempo_map:
+            is_tempo = self.events["type"] == EVENT_CODE["set_tempo"]
+            self.tempo_map = TempoMap(
+                zip(
+                    self.events["tick"][is_tempo].tolist(),
+                    self.events["value"][is_tempo].tolist(),
+                ),
+                self.ppqn,
+            )
+
+    def _abs_ticks_secs(self):
+        """absolute ticks and seconds of every message in the track"""
+        ticks = self.events["tick"]
+        return ticks, self.tempo_map.tick2second(ticks)
+
+    @property
+    def text_encoding(self):
+        """(encoding, confidence) of the text payloads of the track
+
+        Detected once over all text, track_name and lyrics events, with the
+        encoding given to the analyzer tried first, then cached.
+        """
+        if self._text_encoding is None:
+            events = self.events
+            idx = np.flatnonzero(events.mask(*_TEXT_EVENT_TYPES))
+            self._text_encoding = detect_encoding(
+                [events.payload(i) for i in idx.tolist()],
+                encodings=(self.encoding, "cp949"),
+            )
+            self.encoding = self._text_encoding[0]
+        return self._text_encoding
+
+    def decode_texts(self, idx):
+        """decode text payloads of events in bulk by text_encoding
+
+        Returns:
+            stripped texts
+        """
+        encoding, _ = self.text_encoding
+        payloads = [self.events.payload(i) for i in np.asarray(idx).tolist()]
+        # one decode call over the NUL separated payloads
+        texts = (
+            b"\x00".join(payloads)
+            .decode(encoding, errors="replace")
+            .split("\x00")
+        )
+        if len(texts) != len(payloads):  # a payload has NUL bytes itself
+            texts = [
+                payload.decode(encoding, errors="replace")
+                for payload in payloads
+            ]
+        return [text.strip() for text in texts]
+
+    def _lyrics_by_idx(self):
+        """{event idx: lyric} of lyrics events, " " for empty lyrics"""
+        idx = np.flatnonzero(self.events.mask("lyrics"))
+        return {
+            i: lyric or " "
+            for i, lyric in zip(idx.tolist(), self.decode_texts(idx))
+        }
+
     def _init_values(self):
         self.time_signature = DEFAULT_TIME_SIGNATURE
         self.tempo = DEFAULT_TEMPO
@@ -235,289 +1625,396 @@ class MidiTrackAnalyzer:
             result.append(_msg_on)
         return result
 
-    def _quantization(self, msg, unit="32"):
-        q_time = None
-        total_q_time = 0
-        error = 0
-        for note_item in list(Note):
-            beat = tick2beat(msg.time, self.ppqn)
-            q_beat = note_item.value.beat
-            q_time = beat2tick(q_beat, self.ppqn)
-            if beat > q_beat:
-                msg.time -= q_time
-                total_q_time += q_time
-            elif beat == q_beat:  # msg is quantized
-                msg.time += total_q_time
-                return msg, error
-            if unit in note_item.value.name_short:
-                beat_unit = note_item.value.beat  # beat_unit
-                break
-
-        # beat in [0, beat_unit), i.e. beat_unit=0.125
-        beat = tick2beat(msg.time, self.ppqn)
-        if beat < beat_unit / 2:  # beat in [0, beat_unit/2)
-            error = msg.time
-            msg.time = 0  # approximate to beat=0
-        elif beat < beat_unit:  # beat in [beat_unit/2, beat_unit)
-            error = msg.time - beat2tick(beat_unit, self.ppqn)
-            # approximate to beat=beat_unit
-            msg.time = beat2tick(beat_unit, self.ppqn)
-        msg.time += total_q_time
-        return msg, error
-
     def quantization(self, unit="32"):
-        """quantization"""
-        if not any(
-            [unit == n.value.name_short.split("/")[-1] for n in list(Note)]
-        ):
-            raise ValueError
+        """quantization
 
-        error = 0
-        last_note = 0
-        for i, msg in enumerate(self.track):
-            if msg.type in ["note_on", "note_off", "lyrics"]:
-                if not msg.time:
-                    continue
-                if error:
-                    msg.time += error
-                    error = 0
-                msg, error = self._quantization(msg, unit=unit)
-                last_note = i
-
-        if error:
-            self.track[last_note].time += error
+        Absolute ticks of note_on, note_off and lyrics events are snapped to
+        the nearest grid tick of unit ("32", "16", ... or triplet "16t"),
+        so rounding errors don't accumulate. Other events keep their offset
+        from the previous note event. Delta times are rebuilt from the
+        snapped ticks.
+        """
+        q_events = self.events.with_ticks(
+            self._quantized_ticks(self.events, unit)
+        )
+        if self._track is not None:
+            for msg, delta in zip(self._track, q_events["delta"].tolist()):
+                msg.time = delta
+        self._events = q_events
+        self._update_tempo_map()
         return self.track
 
+    def _quantized_ticks(self, events, unit):
+        """absolute ticks of events after quantization"""
+        grid = grid_ticks(unit, self.ppqn)
+        ticks = events["tick"]
+        is_note = events.mask("note_on", "note_off", "lyrics")
+        q_ticks = ticks.copy()
+        q_ticks[is_note] = np.round(
+            np.floor(ticks[is_note] / grid + 0.5) * grid
+        )
+        # other events move with the previous note event, events before the
+        # first note event stay, and none may pass the next note event
+        shift = np.where(is_note, q_ticks - ticks, 0)
+        last_note = np.maximum.accumulate(
+            np.where(is_note, np.arange(len(ticks)), 0)
+        )
+        next_note_tick = np.minimum.accumulate(
+            np.where(is_note, q_ticks, np.iinfo(np.int64).max)[::-1]
+        )[::-1]
+        return np.minimum(ticks + shift[last_note], next_note_tick)
+
     def slice_slience(self):
         """slice_slience"""
         result = []
         chunk = []
-        for msg in self.track:
+        lyrics = self._lyrics_by_idx()
+        for i, msg in enumerate(self.track):
             if msg.type == "lyrics":
-                mmal = MidiMessageAnalyzer_lyrics(msg, encoding=self.encoding)
-                if mmal.lyric == " ":
+                if lyrics[i] == " ":
                     if chunk:
                         result.append(chunk)
                         chunk = []
                 else:
-                    chunk.append(mmal.lyric)
+                    chunk.append(lyrics[i])
             if msg.type == "note_off":
                 chunk.append(msg.note)
 
     def slice(self, begin, end):
         """slice"""
-        pitchs = []
-        durations = []
-        lyrics = ""
-        prev_lyric = ""
-        lyric = ""
-        total_time = 0
-        total_secs = 0
-        prev_total_secs = 0
-        for msg in self.track:
-            total_time += msg.time
-            if msg.type == "note_off":
-                prev_total_secs = total_secs
-            if msg.type == "lyrics":
-                prev_lyric = lyric
-                mmal = MidiMessageAnalyzer_lyrics(msg, encoding=self.encoding)
-                if self.encoding != mmal.encoding:
-                    self.encoding = mmal.encoding
-                lyric = mmal.lyric
-            total_secs += md.tick2second(
-                msg.time,
-                ticks_per_beat=self.ppqn,
-                tempo=self.tempo,
-            )
-            if msg.type == "set_tempo":
-                self.tempo = msg.tempo
-            if begin < total_secs < end:
-                match msg.type:
-                    case "lyrics":
-                        if not lyrics:
-                            lyrics += prev_lyric
-                        lyrics += lyric
-                    case "note_off":
-                        pitchs.append(msg.note)
-                        if not durations:
-                            durations.append(total_secs - begin)
-                        else:
-                            duration = md.tick2second(
-                                msg.time,
-                                ticks_per_beat=self.ppqn,
-                                tempo=self.tempo,
-                            )
-                            durations.append(duration)
-            elif end < total_secs:
-                match msg.type:
-                    case "note_off":
-                        pitchs.append(msg.note)
-                        duration = md.tick2second(
-                            msg.time,
-                            ticks_per_beat=self.ppqn,
-                            tempo=self.tempo,
-                        )
-                        durations.append(end - prev_total_secs)
-                        rprint(len(pitchs), len(durations), len(lyrics))
-                        rprint(pitchs, durations, lyrics)
-                        if not len(pitchs) == len(durations) == len(lyrics):
-                            raise ValueError
-                        return np.array(pitchs), np.array(durations), lyrics
-                    case "end_of_track":
-                        return np.array(pitchs), np.array(durations), lyrics
+        return self.slice_chunks([(begin, end)])[0]
+
+    def slice_chunks(self, chunks):
+        """slice every (begin, end) second chunk in one pass
 
-        return None, None, None
+        A chunk takes the note_off and lyrics events strictly inside it,
+        the lyric before its first lyrics event, and the first note_off
+        after end cut at end. A chunk without a note_off or end_of_track
+        after end gives (None, None, None).
+
+        Returns:
+            list of (pitches, durations, lyrics)
+        """
+        events = self.events
+        types = events["type"]
+        _, secs = self._abs_ticks_secs()
+        num = len(secs)
+        prev_secs = np.concatenate(([0.0], secs[:-1]))
+        note_off_idx = np.flatnonzero(types == EVENT_CODE["note_off"])
+        lyric_idx = np.flatnonzero(types == EVENT_CODE["lyrics"])
+        lyrics = [lyric or " " for lyric in self.decode_texts(lyric_idx)]
+        # first note_off or end_of_track at or after each event
+        is_stop = (types == EVENT_CODE["note_off"]) | (
+            types == EVENT_CODE["end_of_track"]
+        )
+        next_stop = np.minimum.accumulate(
+            np.where(is_stop, np.arange(num), num)[::-1]
+        )[::-1]
+        next_stop = np.append(next_stop, num)
+
+        chunks = np.asarray(chunks, dtype=np.float64).reshape(-1, 2)
+        begins, ends = chunks[:, 0], chunks[:, 1]
+        # events in begin < second < end, then the first after end
+        firsts = np.searchsorted(secs, begins, side="right")
+        lasts = np.searchsorted(secs, ends, side="left")
+        stops = next_stop[np.searchsorted(secs, ends, side="right")]
+        note_off_bounds = np.searchsorted(note_off_idx, [firsts, lasts])
+        lyric_bounds = np.searchsorted(lyric_idx, [firsts, lasts])
+
+        result = []
+        for i, (begin, end, stop) in enumerate(
+            zip(begins.tolist(), ends.tolist(), stops.tolist())
+        ):
+            if firsts[i] >= lasts[i]:  # empty chunk
+                note_offs = note_off_idx[:0]
+                chunk_lyrics = ""
+            else:
+                note_offs = note_off_idx[slice(*note_off_bounds[:, i])]
+                lyric_begin, lyric_end = lyric_bounds[:, i].tolist()
+                chunk_lyrics = "".join(lyrics[lyric_begin:lyric_end])
+                if chunk_lyrics and lyric_begin:
+                    chunk_lyrics = lyrics[lyric_begin - 1] + chunk_lyrics
+            durations = secs[note_offs] - prev_secs[note_offs]
+            if len(note_offs):
+                durations[0] = secs[note_offs[0]] - begin
+            if stop == num:
+                result.append((None, None, None))
+                continue
+            pitches = events["note"][note_offs].tolist()
+            durations = durations.tolist()
+            if types[stop] == EVENT_CODE["note_off"]:
+                pitches.append(int(events["note"][stop]))
+                durations.append(end - prev_secs[stop])
+                if not len(pitches) == len(durations) == len(chunk_lyrics):
+                    raise ValueError
+            result.append(
+                (np.array(pitches), np.array(durations), chunk_lyrics)
+            )
+        return result
 
     def split_space_note(self, remove_silence_threshold=0.3):
-        """split_space_note"""
-        modified_track = []
-        error = 0
-        note_in = False
-        for msg in self.track:
-            match msg.type:
-                case "note_on":
-                    note_in = True
-                    time = md.tick2second(
-                        msg.time,
-                        ticks_per_beat=self.ppqn,
-                        tempo=self.tempo,
-                    )
-                    if time > remove_silence_threshold:
-                        modified_track += [
-                            Message("note_on", time=0),
-                            MetaMessage("lyrics", text=" "),
-                            Message("note_off", time=msg.time),
-                        ]
-                    else:  # just remove time
-                        error += time
-                    msg.time = 0
-                case "note_off":
-                    note_in = False
-                    if error:
-                        msg.time += md.second2tick(
-                            error, ticks_per_beat=self.ppqn, tempo=self.tempo
-                        )
-                        error = 0
-                case "set_tempo":
-                    time = md.tick2second(
-                        msg.time,
-                        ticks_per_beat=self.ppqn,
-                        tempo=self.tempo,
-                    )
-                    if not note_in and time > remove_silence_threshold:
-                        modified_track += [
-                            Message("note_on", time=0),
-                            MetaMessage("lyrics", text=" "),
-                            Message("note_off", time=msg.time),
-                        ]
-                    else:
-                        error += time
-                    msg.time = 0
-                    self.tempo = msg.tempo
-                case _:
-                    time = md.tick2second(
-                        msg.time,
-                        ticks_per_beat=self.ppqn,
-                        tempo=self.tempo,
-                    )
-                    if not note_in and time > remove_silence_threshold:
-                        modified_track += [
-                            Message("note_on", time=0),
-                            MetaMessage("lyrics", text=" "),
-                            Message("note_off", time=msg.time),
-                        ]
-                    else:
-                        error += time
-                    msg.time = 0
-            modified_track.append(msg)
-        self.track = modified_track
+        """split_space_note
+
+        A gap longer than remove_silence_threshold seconds before a note_on,
+        or before another event while no note sounds, becomes a rest: a
+        note_on, a " " lyrics and a note_off taking the gap. Shorter gaps
+        are removed and their time is added to the next note_off.
+        """
+        self.events = self._split_space_events(remove_silence_threshold)
+        self._update_tempo_map()
         return self.track
 
-    def print_note_num(self, note_num):
+    def _split_space_events(self, remove_silence_threshold):
+        """event table of split_space_note, written into one new array"""
+        events = self.events
+        types = events["type"]
+        num = len(events)
+        ticks, secs = self._abs_ticks_secs()
+        times = np.diff(secs, prepend=0)
+        idx = np.arange(num)
+        is_note_on = types == EVENT_CODE["note_on"]
+        is_note_off = types == EVENT_CODE["note_off"]
+        # a note sounds before an event if the last note switch is note_on
+        last_switch = np.maximum.accumulate(
+            np.where(is_note_on | is_note_off, idx, -1)
+        )
+        prev_switch = np.concatenate(([-1], last_switch[:-1]))
+        note_in = (prev_switch >= 0) & is_note_on[np.maximum(prev_switch, 0)]
+        is_rest = (times > remove_silence_threshold) & (
+            is_note_on | ~(is_note_off | note_in)
+        )
+
+        # removed gaps since the previous note_off, in ticks of the tempo
+        # at each note_off
+        note_off_idx = np.flatnonzero(is_note_off)
+        gaps = np.where(is_note_off | is_rest, 0.0, times)
+        segment_begins = np.concatenate(([0], note_off_idx[:-1] + 1))
+        errors = np.zeros(len(note_off_idx))
+        nonempty = segment_begins < note_off_idx
+        if nonempty.any():
+            errors[nonempty] = np.add.reduceat(
+                gaps, np.stack((segment_begins, note_off_idx), axis=1).ravel()
+            )[::2][nonempty]
+        scales = (
+            self.tempo_map.tempo_at(ticks[note_off_idx]) * 1e-6 / self.ppqn
+        )
+        deltas = np.zeros(num, dtype=np.int64)
+        deltas[note_off_idx] = events["delta"][note_off_idx] + np.round(
+            errors / scales
+        ).astype(np.int64)
+
+        # rest note_on, lyrics and note_off before each rest event
+        rest_idx = np.flatnonzero(is_rest)
+        positions = idx + 3 * np.cumsum(is_rest)
+        split_events = np.zeros(num + 3 * len(rest_idx), dtype=EVENT_DTYPE)
+        split_events[positions] = events.events
+        split_events["delta"][positions] = deltas
+        rest_positions = positions[rest_idx]
+        for offset, event_type in zip(
+            (3, 2, 1), ("note_on", "lyrics", "note_off")
+        ):
+            split_events["type"][rest_positions - offset] = EVENT_CODE[
+                event_type
+            ]
+        split_events["velocity"][rest_positions - 3] = 64
+        split_events["offset"][rest_positions - 2] = len(events.buffer)
+        split_events["length"][rest_positions - 2] = 1
+        split_events["velocity"][rest_positions - 1] = 64
+        split_events["delta"][rest_positions - 1] = events["delta"][rest_idx]
+        split_events["tick"] = np.cumsum(split_events["delta"])
+        return MidiEventTable(split_events, events.buffer + b" ")
+
+    def normalize(self, remove_silence_threshold=0.3, unit="32"):
+        """split_space_note and quantization as one stage
+
+        The split events are quantized before any track or tempo map is
+        rebuilt from them.
+
+        Returns:
+            normalized MidiEventTable
+        """
+        events = self._split_space_events(remove_silence_threshold)
+        self.events = events.with_ticks(self._quantized_ticks(events, unit))
+        self._update_tempo_map()
+        return self.events
+
+    def print_note_num(
+        self, note_num, tempo=None, time_signature=None, console=None
+    ):
         """print_note_num"""
+        if tempo is None:
+            tempo = self.tempo
+        if time_signature is None:
+            time_signature = self.time_signature
         color = "color(240)" if note_num == 0 else "color(47)"
-        bpm = round(
-            md.tempo2bpm(self.tempo, time_signature=self.time_signature)
-        )
+        bpm = round(md.tempo2bpm(tempo, time_signature=time_signature))
         info = f"[bold {color}]Total item num of BPM({bpm}): " + f"{note_num}"
-        Console().rule(info, style=f"{color}")
+        (Console() if console is None else console).rule(
+            info, style=f"{color}"
+        )
+
+    def notes(self):
+        """notes of the track as NoteColumns
 
-    def to_json(self, file_path, dir_path=None):
-        """to_json"""
+        Each note_off ends the last note_on and takes the last lyric.
+        """
         self._init_values()
-        total_time = 0
-        lyric = ""
-        data = {"notes": []}
-        note_data = {
-            "start_time": None,
-            "end_time": None,
-            "length": None,
-            "pitch": None,
-            "lyric": None,
-        }
-        duration = 0
-        for i, msg in enumerate(self.track):
-            total_time += msg.time
-            duration += msg.time
-            self.length += md.tick2second(
-                msg.time,
-                ticks_per_beat=self.ppqn,
-                tempo=self.tempo,
-            )
-            msg_kwarg = {
-                "msg": msg,
-                "ppqn": self.ppqn,
-                "tempo": self.tempo,
-                "idx": i,
-                "length": self.length,
-            }
-            match msg.type:
-                case "note_on":
-                    note_on_time = self.length
-                    duration = 0
-                case "note_off":
-                    _note_data = note_data.copy()
-                    _note_data["start_time"] = note_on_time
-                    _note_data["end_time"] = self.length
-                    _note_data["length"] = md.tick2second(
-                        duration,
-                        ticks_per_beat=self.ppqn,
-                        tempo=self.tempo,
-                    )
-                    _note_data["pitch"] = msg.note
-                    if not lyric:
-                        raise ValueError
-                    _note_data["lyric"] = lyric
-                    if None in _note_data.values():
-                        raise ValueError
-                    data["notes"].append(_note_data)
-                case "lyrics":
-                    mmal = MidiMessageAnalyzer_lyrics(
-                        **msg_kwarg,
-                        encoding=self.encoding,
-                    )
-                    if self.encoding != mmal.encoding:
-                        self.encoding = mmal.encoding
-                    _, lyric = mmal.analysis()
-                case "set_tempo":
-                    _, self.tempo = MidiMessageAnalyzer_set_tempo(
-                        **msg_kwarg,
-                        time_signature=self.time_signature,
-                    ).analysis()
-                case "time_signature":
-                    _, self.time_signature = (
-                        MidiMessageAnalyzer_time_signature(
-                            **msg_kwarg
-                        ).analysis()
-                    )
+        events = self.events
+        _, secs = self._abs_ticks_secs()
+        idx = np.arange(len(events))
+        is_lyric = events["type"] == EVENT_CODE["lyrics"]
+        last_note_on = np.maximum.accumulate(
+            np.where(events["type"] == EVENT_CODE["note_on"], idx, -1)
+        )
+        last_lyric = np.cumsum(is_lyric) - 1
+        note_off = np.flatnonzero(events["type"] == EVENT_CODE["note_off"])
+        if (last_note_on[note_off] < 0).any():
+            raise ValueError
+        if (last_lyric[note_off] < 0).any():
+            raise ValueError
+        lyrics = [
+            lyric or " "
+            for lyric in self.decode_texts(np.flatnonzero(is_lyric))
+        ]
+        start_times = secs[last_note_on[note_off]]
+        end_times = secs[note_off]
+        notes = NoteColumns(
+            start_time=start_times,
+            end_time=end_times,
+            length=end_times - start_times,
+            pitch=events["note"][note_off].astype(np.int64),
+            lyric=last_lyric[note_off],
+            lyrics=np.array(lyrics, dtype=str),
+        )
+        if len(secs):
+            self.length = float(secs[-1])
+            self.tempo = int(self.tempo_map.tempo_at(events["tick"][-1]))
+        time_signature = np.flatnonzero(
+            events["type"] == EVENT_CODE["time_signature"]
+        )
+        if len(time_signature):
+            numerator, denominator = events.payload(time_signature[-1])[:2]
+            self.time_signature = (numerator, 2**denominator)
+        return notes
+
+    def to_json(self, file_path, dir_path=None, writer="json"):
+        """to_json, writer is a key of NOTE_WRITERS
+
+        Returns:
+            written file path
+        """
+        suffix, write_notes = NOTE_WRITERS[writer]
+        notes = self.notes()
         if dir_path is None:
             dir_path = Path("")
         else:
             dir_path = Path(dir_path)
             dir_path.mkdir(exist_ok=True, parents=True)
-        file_path = dir_path / Path(file_path).with_suffix(".json").name
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        file_path = dir_path / Path(file_path).with_suffix(suffix).name
+        write_notes(file_path, notes)
+        return file_path
+
+    def records(self, track_bound=None):
+        """analysis track without rendering
+
+        Every event up to track_bound gets a row of ANALYSIS_DTYPE; only
+        events with an ANALYSIS_HANDLERS entry go through the running
+        AnalysisState, durations are looked up for all rows at once.
+
+        Returns:
+            TrackRecords
+        """
+        self._init_values()
+        events = self.events
+        ticks = events["tick"]
+        num = len(events)
+        if track_bound is not None and track_bound < num:
+            num = int(track_bound) + 1
+        records = np.zeros(num, dtype=ANALYSIS_DTYPE)
+        records["idx"] = np.arange(num)
+        for name in ("type", "tick", "delta", "channel", "note", "value"):
+            records[name] = events[name][:num]
+        records["second"] = self.tempo_map.tick2second(ticks[:num])
+        # tempo of each delta time, i.e. in effect at the previous message
+        records["tempo"] = self.tempo_map.tempo_at(
+            np.concatenate(([0], ticks[: num - 1]))
+        )[:num]
+        records["slot"] = -1
+        records["text"] = -1
+
+        types = records["type"]
+        text_idx = np.flatnonzero(events.mask(*_TEXT_EVENT_TYPES)[:num])
+        texts = self.decode_texts(text_idx)
+        records["text"][text_idx] = np.arange(len(text_idx))
+        is_lyric = types == EVENT_CODE["lyrics"]
+        lyric = "".join(
+            texts[i] or " " for i in records["text"][is_lyric].tolist()
+        )
+
+        signature_idx = np.flatnonzero(types == EVENT_CODE["time_signature"])
+        for i in signature_idx.tolist():
+            numerator, denominator = events.payload(i)[:2]
+            records[i]["numerator"] = numerator
+            records[i]["denominator"] = 2**denominator
+
+        state = AnalysisState()
+        for i in np.flatnonzero(
+            np.isin(types, list(ANALYSIS_HANDLERS))
+        ).tolist():
+            record = records[i]
+            ANALYSIS_HANDLERS[int(record["type"])](state, record)
+
+        # time signature in effect after each event
+        last_signature = np.maximum.accumulate(
+            np.where(types == EVENT_CODE["time_signature"], records["idx"], -1)
+        )
+        for name, default in zip(
+            ("numerator", "denominator"), DEFAULT_TIME_SIGNATURE
+        ):
+            records[name] = np.where(
+                last_signature < 0,
+                default,
+                records[name][np.maximum(last_signature, 0)],
+            )
+
+        # closest durations of the delta times, as rest unless a note sounds
+        records["rest"] = np.isin(
+            types, [EVENT_CODE["note_on"], EVENT_CODE["rest"]]
+        ) | ((types == EVENT_CODE["note_off"]) & (records["slot"] < 0))
+        has_duration = np.isin(
+            types,
+            [
+                EVENT_CODE["note_on"],
+                EVENT_CODE["note_off"],
+                EVENT_CODE["rest"],
+                EVENT_CODE["lyrics"],
+            ],
+        ) & (records["delta"] > 0)
+        records["duration"] = -1
+        for as_rest in (False, True):
+            rows = has_duration & (records["rest"] == as_rest)
+            _, idx, errors = closest_durations(
+                records["delta"][rows], self.ppqn, as_rest=as_rest
+            )
+            records["duration"][rows] = idx
+            records["error"][rows] = errors
+
+        self.tempo = state.tempo
+        self.time_signature = state.time_signature
+        total_time = int(ticks[-1]) if len(ticks) else 0
+        self.length = float(self.tempo_map.tick2second(total_time))
+        return TrackRecords(
+            records=records,
+            texts=texts,
+            segments=state.segments,
+            lyric=lyric,
+            encoding=self.encoding,
+            encoding_confidence=self.text_encoding[1],
+            length=self.length,
+            total_time=total_time,
+            tempo=self.tempo,
+            time_signature=self.time_signature,
+        )
 
     def analysis(
         self,
@@ -526,103 +2023,141 @@ class MidiTrackAnalyzer:
         blind_time=False,
         blind_lyric=True,
         blind_note_info=False,
+        render=True,
+        console=None,
     ):
-        """analysis track"""
-        self._init_values()
-        note_address = 0
-        note_num = 0
-        first_tempo = True
-        prev_tempo = None
-        note_queue = {}
-        if track_bound is None:
-            track_bound = float("inf")
-        lyric = ""
-        total_time = 0
-        for i, msg in enumerate(self.track):
-            if i > track_bound:
-                break
-            total_time += msg.time
-            self.length += md.tick2second(
-                msg.time,
-                ticks_per_beat=self.ppqn,
-                tempo=self.tempo,
+        """analysis track
+
+        With render=False nothing is printed and the TrackRecords are
+        returned.
+        """
+        track_records = self.records(track_bound=track_bound)
+        if render:
+            self.render(
+                track_records,
+                blind_note=blind_note,
+                blind_time=blind_time,
+                blind_lyric=blind_lyric,
+                blind_note_info=blind_note_info,
+                console=console,
             )
+        return track_records
+
+    def write_jsonl(self, track_records, file, track=None):
+        """write TrackRecords to a text file, one json object per event"""
+        texts = track_records.texts
+        names = {
+            as_rest: [
+                note.name_short
+                for note in duration_table(self.ppqn, as_rest).notes
+            ]
+            for as_rest in (False, True)
+        }
+        lines = []
+        for record in track_records.records.tolist():
+            row = dict(zip(ANALYSIS_DTYPE.names, record))
+            row["type"] = EVENT_TYPES[row["type"]]
+            row["duration"] = (
+                names[row["rest"]][row["duration"]]
+                if row["duration"] >= 0
+                else None
+            )
+            row["text"] = texts[row["text"]] if row["text"] >= 0 else None
+            if track is not None:
+                row["track"] = track
+            lines.append(json.dumps(row, ensure_ascii=False))
+            if len(lines) == 1024:
+                file.write("\n".join(lines) + "\n")
+                lines.clear()
+        if lines:
+            file.write("\n".join(lines) + "\n")
+
+    def render(
+        self,
+        track_records,
+        blind_note=False,
+        blind_time=False,
+        blind_lyric=True,
+        blind_note_info=False,
+        console=None,
+        batch_size=1000,
+    ):
+        """print TrackRecords by rich
+
+        Lines are printed by one console in batches of batch_size.
+        """
+        if console is None:
+            console = Console()
+        lines = []
+
+        def flush():
+            if lines:
+                console.print("\n".join(lines))
+                lines.clear()
+
+        note_address = 0
+        sound_kwarg = {
+            "blind_time": blind_time,
+            "blind_note": blind_note,
+            "blind_note_info": blind_note_info,
+        }
+        texts = track_records.texts
+        for record in track_records.records:
+            i = int(record["idx"])
+            event_type = EVENT_TYPES[record["type"]]
             msg_kwarg = {
-                "msg": msg,
+                "msg": self.track[i],
                 "ppqn": self.ppqn,
-                "tempo": self.tempo,
+                "tempo": int(record["tempo"]),
                 "idx": i,
-                "length": self.length,
+                "length": float(record["second"]),
             }
-            match msg.type:
+            time_signature = (
+                int(record["numerator"]),
+                int(record["denominator"]),
+            )
+            if i in track_records.segments and self.convert_1_to_0:
+                flush()
+                self.print_note_num(
+                    *track_records.segments[i], console=console
+                )
+            match event_type:
                 case "note_on":
-                    result, note_address = MidiMessageAnalyzer_note_on(
-                        **msg_kwarg, note_queue=note_queue
-                    ).analysis(
-                        blind_time=blind_time,
-                        blind_note=blind_note,
-                        blind_note_info=blind_note_info,
+                    note_address = int(record["slot"])
+                    result = MidiMessageAnalyzer_note_on(**msg_kwarg).analysis(
+                        slot=note_address, **sound_kwarg
                     )
                 case "note_off":
                     result = MidiMessageAnalyzer_note_off(
-                        **msg_kwarg, note_queue=note_queue
-                    ).analysis(
-                        blind_time=blind_time,
-                        blind_note=blind_note,
-                        blind_note_info=blind_note_info,
-                    )
+                        **msg_kwarg
+                    ).analysis(slot=int(record["slot"]), **sound_kwarg)
                 case "rest":
-                    result = MidiMessageAnalyzer_rest(
-                        **msg_kwarg, note_queue=note_queue
-                    ).analysis(
-                        blind_time=blind_time,
-                        blind_note=blind_note,
-                        blind_note_info=blind_note_info,
+                    result = MidiMessageAnalyzer_rest(**msg_kwarg).analysis(
+                        **sound_kwarg
                     )
                 case "lyrics":
-                    mmal = MidiMessageAnalyzer_lyrics(
+                    result = MidiMessageAnalyzer_lyrics(
                         **msg_kwarg,
-                        encoding=self.encoding,
-                    )
-                    if self.encoding != mmal.encoding:
-                        self.encoding = mmal.encoding
-                    result, _lyric = mmal.analysis(
-                        note_address=note_address,
-                        blind_time=blind_time,
-                        blind_note=blind_note,
-                        blind_note_info=blind_note_info,
-                    )
-                    lyric += _lyric
+                        encoding=track_records.encoding,
+                        text=texts[record["text"]],
+                    ).analysis(note_address=note_address, **sound_kwarg)
                 case "measure":
+                    flush()
                     result = MidiMessageAnalyzer_measure(
-                        self.time_signature
-                    ).analysis()
+                        time_signature
+                    ).analysis(console=console)
                 case "text" | "track_name":
-                    mmat = MidiMessageAnalyzer_text(
+                    result = MidiMessageAnalyzer_text(
                         **msg_kwarg,
-                        encoding=self.encoding,
-                    )
-                    if self.encoding != mmat.encoding:
-                        self.encoding = mmat.encoding
-                    result = mmat.analysis(blind_time=blind_time)
+                        encoding=track_records.encoding,
+                        text=texts[record["text"]],
+                    ).analysis(blind_time=blind_time)
                 case "set_tempo":
-                    if not first_tempo and self.convert_1_to_0:
-                        self.print_note_num(note_num)
-                    first_tempo = False
-                    result, self.tempo = MidiMessageAnalyzer_set_tempo(
+                    result = MidiMessageAnalyzer_set_tempo(
                         **msg_kwarg,
-                        time_signature=self.time_signature,
+                        time_signature=time_signature,
                     ).analysis(blind_time=blind_time)
-                    if prev_tempo is None:
-                        prev_tempo = self.tempo
-                    if note_num:
-                        prev_tempo = self.tempo
-                        note_num = 0
-                    else:
-                        self.tempo = prev_tempo
                 case "end_of_track":
-                    if self.convert_1_to_0:
-                        self.print_note_num(note_num)
                     result = MidiMessageAnalyzer_end_of_track(
                         **msg_kwarg
                     ).analysis(blind_time=blind_time)
@@ -631,35 +2166,298 @@ class MidiTrackAnalyzer:
                         **msg_kwarg
                     ).analysis(blind_time=blind_time)
                 case "time_signature":
-                    result, self.time_signature = (
-                        MidiMessageAnalyzer_time_signature(
-                            **msg_kwarg
-                        ).analysis(blind_time=blind_time)
-                    )
+                    result = MidiMessageAnalyzer_time_signature(
+                        **msg_kwarg
+                    ).analysis(blind_time=blind_time)
                 case _:
                     result = MidiMessageAnalyzer(**msg_kwarg).analysis(
                         blind_time=blind_time
                     )
-
+            if isinstance(result, tuple):
+                result = result[0]
             if result:
-                rprint(result)
-
-            if msg.type in ["note_on", "note_off", "lyrics"]:
-                note_num += 1
-
-        rprint(f"Track lyric encode: {self.encoding}")
-        self.length = md.tick2second(
-            total_time,
-            ticks_per_beat=self.ppqn,
-            tempo=self.tempo,
+                lines.append(result)
+                if len(lines) >= batch_size:
+                    flush()
+
+        lines.append(f"Track lyric encode: {track_records.encoding}")
+        lines.append(
+            "Track total secs/time: "
+            + f"{track_records.length}/{track_records.total_time}"
         )
-        rprint("Track total secs/time: " + f"{self.length}/{total_time}")
         bpm = round(
-            md.tempo2bpm(self.tempo, time_signature=self.time_signature)
+            md.tempo2bpm(
+                track_records.tempo,
+                time_signature=track_records.time_signature,
+            )
         )
-        rprint("bpm(tempo): " + f"{bpm}({self.tempo})")
+        lines.append("bpm(tempo): " + f"{bpm}({track_records.tempo})")
+        flush()
         if not blind_lyric:
-            print(f'LYRIC: "{lyric}"')
+            console.print(
+                f'LYRIC: "{track_records.lyric}"',
+                markup=False,
+                highlight=False,
+                emoji=False,
+                soft_wrap=True,
+            )
+
+
+class VoiceAllocator:
+    """Slots of sounding notes for note_on/note_off pairing
+
+    A note_on takes the lowest free slot from a min-heap, and a note_off of
+    the same (channel, note) releases the last slot taken by that pitch, so
+    both are O(log active notes) however dense the polyphony is.
+    """
+
+    def __init__(self):
+        self.free_slots = []  # min-heap of released slots
+        self.slot_num = 0
+        self.slots = defaultdict(list)  # (channel, note): stack of slots
+
+    def __len__(self):
+        return self.slot_num - len(self.free_slots)
+
+    def alloc(self, channel, note):
+        """take the lowest free slot for a note"""
+        if self.free_slots:
+            slot = heapq.heappop(self.free_slots)
+        else:
+            slot = self.slot_num
+            self.slot_num += 1
+        self.slots[channel, note].append(slot)
+        return slot
+
+    def free(self, channel, note):
+        """release the last slot of a note, None if the note isn't on"""
+        stack = self.slots.get((channel, note))
+        if not stack:
+            return None
+        slot = stack.pop()
+        heapq.heappush(self.free_slots, slot)
+        return slot
+
+
+ANALYSIS_DTYPE = np.dtype(
+    [
+        ("idx", np.int64),
+        ("type", np.uint8),  # index of EVENT_TYPES
+        ("tick", np.int64),
+        ("delta", np.int64),
+        ("second", np.float64),  # absolute second
+        ("tempo", np.int64),  # tempo of the delta time
+        ("channel", np.int8),
+        ("note", np.int16),
+        ("value", np.int64),  # tempo of set_tempo
+        ("numerator", np.int16),  # time signature after the event
+        ("denominator", np.int16),
+        ("slot", np.int64),  # voice slot of note_on/note_off, -1 if none
+        ("duration", np.int16),  # index of duration_table, -1 if none
+        ("rest", np.bool_),  # duration is of the rest table
+        ("error", np.float64),  # beat error of the duration
+        ("text", np.int64),  # index in texts, -1 if none
+    ]
+)
+
+TrackRecords = namedtuple(
+    "TrackRecords",
+    [
+        "records",  # ANALYSIS_DTYPE array, one row per analyzed event
+        "texts",  # decoded text/track_name/lyrics
+        "segments",  # {record idx: (note num, tempo, time signature)}
+        "lyric",
+        "encoding",
+        "encoding_confidence",  # fraction of texts decodable by encoding
+        "length",
+        "total_time",
+        "tempo",
+        "time_signature",
+    ],
+)
+
+
+class AnalysisState:
+    """Running state of a track analysis
+
+    The tempo follows MidiTrackAnalyzer.analysis: a set_tempo only takes
+    effect if notes were counted since the previous one. segments records
+    the note count of each ended tempo segment.
+    """
+
+    def __init__(self):
+        self.voices = VoiceAllocator()
+        self.tempo = DEFAULT_TEMPO
+        self.prev_tempo = None
+        self.first_tempo = True
+        self.time_signature = DEFAULT_TIME_SIGNATURE
+        self.note_num = 0
+        self.segments = {}
+
+    def on_note_on(self, record):
+        """take a voice slot"""
+        record["slot"] = self.voices.alloc(record["channel"], record["note"])
+        self.note_num += 1
+
+    def on_note_off(self, record):
+        """release a voice slot"""
+        slot = self.voices.free(record["channel"], record["note"])
+        record["slot"] = -1 if slot is None else slot
+        self.note_num += 1
+
+    def on_lyrics(self, record):
+        """count lyrics as notes of the tempo segment"""
+        self.note_num += 1
+
+    def on_set_tempo(self, record):
+        """end the tempo segment"""
+        if not self.first_tempo:
+            self.on_end_of_track(record)
+        self.first_tempo = False
+        self.tempo = int(record["value"])
+        if self.prev_tempo is None:
+            self.prev_tempo = self.tempo
+        if self.note_num:
+            self.prev_tempo = self.tempo
+            self.note_num = 0
+        else:
+            self.tempo = self.prev_tempo
+
+    def on_time_signature(self, record):
+        """update time signature"""
+        self.time_signature = (
+            int(record["numerator"]),
+            int(record["denominator"]),
+        )
+
+    def on_end_of_track(self, record):
+        """note num of the tempo segment ending at record"""
+        self.segments[int(record["idx"])] = (
+            self.note_num,
+            self.tempo,
+            self.time_signature,
+        )
+
+
+# type code: AnalysisState handler, other events don't change the state
+ANALYSIS_HANDLERS = {
+    EVENT_CODE["note_on"]: AnalysisState.on_note_on,
+    EVENT_CODE["note_off"]: AnalysisState.on_note_off,
+    EVENT_CODE["lyrics"]: AnalysisState.on_lyrics,
+    EVENT_CODE["set_tempo"]: AnalysisState.on_set_tempo,
+    EVENT_CODE["time_signature"]: AnalysisState.on_time_signature,
+    EVENT_CODE["end_of_track"]: AnalysisState.on_end_of_track,
+}
+
+
+class MidiStreamAnalyzer:
+    """Incremental analysis of a stream of track messages
+
+    Messages come one by one with delta ticks as time, from a mido track,
+    a generator or a mido port, and each gives its ANALYSIS_DTYPE record
+    right away, so the track is never buffered. Tempo, time signature,
+    voices, lyric buffer and quantization error are running state; the
+    lyric encoding sticks to the first of encoding/cp949 that decodes.
+    """
+
+    def __init__(self, ppqn=DEFAULT_PPQN, encoding="utf-8"):
+        self.ppqn = ppqn
+        self.encoding = encoding
+        self.state = AnalysisState()
+        self.tempo = DEFAULT_TEMPO  # tempo of the next delta time
+        self.time_signature = DEFAULT_TIME_SIGNATURE
+        self.idx = 0
+        self.tick = 0
+        self.second = 0.0
+        self.lyric_buffer = []
+        self.error = 0.0  # sum of absolute beat errors of durations
+        self.duration_num = 0
+
+    def _decode(self, data):
+        encoding, confidence = detect_encoding(
+            [data], encodings=(self.encoding, "cp949")
+        )
+        if confidence:
+            self.encoding = encoding
+        return data.decode(self.encoding, errors="replace").strip()
+
+    def feed(self, msg):
+        """analysis a message
+
+        Returns:
+            (record of ANALYSIS_DTYPE, decoded text or None), text is of
+            text/track_name/lyrics and record["text"] is -1
+        """
+        code, channel, note, _, value, data = event_fields(msg)
+        record = np.zeros(1, dtype=ANALYSIS_DTYPE)[0]
+        record["idx"] = self.idx
+        record["type"] = code
+        record["tick"] = self.tick + msg.time
+        record["delta"] = msg.time
+        scale = self.tempo * 1e-6 / self.ppqn
+        record["second"] = self.second + msg.time * scale
+        record["tempo"] = self.tempo
+        record["channel"] = channel
+        record["note"] = note
+        record["value"] = value
+        record["slot"] = -1
+        record["text"] = -1
+        record["duration"] = -1
+
+        text = None
+        if EVENT_TYPES[code] in _TEXT_EVENT_TYPES:
+            text = self._decode(data)
+        elif code == EVENT_CODE["time_signature"]:
+            numerator, denominator = data[:2]
+            self.time_signature = (numerator, 2**denominator)
+        record["numerator"], record["denominator"] = self.time_signature
+        handler = ANALYSIS_HANDLERS.get(code)
+        if handler is not None:
+            handler(self.state, record)
+        if code == EVENT_CODE["set_tempo"]:
+            self.tempo = value
+        elif code == EVENT_CODE["lyrics"]:
+            self.lyric_buffer.append(text or " ")
+
+        # closest duration of the delta time, as rest unless a note sounds
+        record["rest"] = code in (
+            EVENT_CODE["note_on"],
+            EVENT_CODE["rest"],
+        ) or (code == EVENT_CODE["note_off"] and record["slot"] < 0)
+        if msg.time > 0 and code in (
+            EVENT_CODE["note_on"],
+            EVENT_CODE["note_off"],
+            EVENT_CODE["rest"],
+            EVENT_CODE["lyrics"],
+        ):
+            _, idx, errors = closest_durations(
+                [msg.time], self.ppqn, as_rest=bool(record["rest"])
+            )
+            record["duration"] = idx[0]
+            record["error"] = errors[0]
+            self.error += abs(float(errors[0]))
+            self.duration_num += 1
+
+        self.idx += 1
+        self.tick = int(record["tick"])
+        self.second = float(record["second"])
+        return record, text
+
+    def analysis(self, messages):
+        """feed messages lazily, yields (record, text) of each message"""
+        for msg in messages:
+            yield self.feed(msg)
+
+    def pop_lyric(self):
+        """lyric buffered since the last pop"""
+        lyric = "".join(self.lyric_buffer)
+        self.lyric_buffer.clear()
+        return lyric
+
+    @property
+    def mean_error(self):
+        """mean absolute beat error of the durations so far"""
+        return self.error / self.duration_num if self.duration_num else 0.0
 
 
 class MidiMessageAnalyzer:
@@ -790,13 +2588,16 @@ class MidiMessageAnalyzer_measure(MidiMessageAnalyzer):
         """inc_idx"""
         cls.idx += 1
 
-    def analysis(self):
+    def analysis(self, console=None):
         """print measure"""
-        Console(width=50).rule(
-            f"[#ffffff]𝄞 {self.time_signature[0]}/{self.time_signature[1]} "
-            + f"measure {self.idx}[/#ffffff]",
-            style="#ffffff",
-            characters="=",
+        (Console() if console is None else console).print(
+            Rule(
+                f"[#ffffff]𝄞 {self.time_signature[0]}/{self.time_signature[1]} "
+                + f"measure {self.idx}[/#ffffff]",
+                style="#ffffff",
+                characters="=",
+            ),
+            width=50,
         )
         self.inc_idx()
         return ""
@@ -814,11 +2615,18 @@ class MidiMessageAnalyzer_text(MidiMessageAnalyzer):
         length=0,
         encoding="utf-8",
         encoding_alternative="cp949",
+        text=None,
     ):
+        """text: already decoded text, then encoding is not detected"""
         super().__init__(msg, ppqn, tempo=tempo, idx=idx, length=length)
-        self._init_encoding(
-            encoding=encoding, encoding_alternative=encoding_alternative
-        )
+        if text is None:
+            self._init_encoding(
+                encoding=encoding, encoding_alternative=encoding_alternative
+            )
+            text = self.encoded_text.decode(self.encoding)
+        else:
+            self.encoding = encoding
+        self.text = text.strip()
 
     def _init_encoding(self, encoding="utf-8", encoding_alternative="cp949"):
         self.encoded_text = self.msg.bin()[3:]
@@ -837,9 +2645,8 @@ class MidiMessageAnalyzer_text(MidiMessageAnalyzer):
 
     def analysis(self, blind_time=False):
         """analysis text"""
-        text = self.encoded_text.decode(self.encoding).strip()
         return self.result(
-            head=self.info_type(), body=text, blind_time=blind_time
+            head=self.info_type(), body=self.text, blind_time=blind_time
         )
 
 
@@ -853,7 +2660,7 @@ class MidiMessageAnalyzer_SoundUnit(MidiMessageAnalyzer):
         tempo=DEFAULT_TEMPO,
         idx=0,
         length=0,
-        note_queue=None,
+        voices=None,
     ):
         super().__init__(
             msg,
@@ -862,42 +2669,16 @@ class MidiMessageAnalyzer_SoundUnit(MidiMessageAnalyzer):
             idx=idx,
             length=length,
         )
-        if note_queue is None:
-            self.note_queue = {}
+        if voices is None:
+            self.voices = VoiceAllocator()
         else:
-            self.note_queue = note_queue
-
-    def note_queue_find(self, value):
-        """note_queue_find"""
-        for k, v in self.note_queue.items():
-            if v == value:
-                return k
-        return None
-
-    def note_queue_alloc(self):
-        """note_queue_alloc"""
-        address = 0
-        while True:
-            try:
-                self.note_queue[address]
-                address += 1
-            except KeyError:
-                return address
+            self.voices = voices
 
     def closest_note(self, tick, as_rest=False):
         """select minimum error"""
         if tick == 0:
             return None, None
-        beat = tick2beat(tick, self.ppqn)
-        min_error = float("inf")
-        quantized_note = None
-        note_enum = Rest_all if as_rest else Note_all
-        for note in note_enum:
-            error = note.value.beat - beat
-            if abs(error) < min_error:
-                min_error = error
-                quantized_note = note.value
-        return min_error, quantized_note
+        return closest_duration(tick, self.ppqn, as_rest=as_rest)
 
     def quantization_info(
         self, error, real_beat, quantized_note, quantization_color="color(85)"
@@ -931,14 +2712,17 @@ class MidiMessageAnalyzer_note_on(MidiMessageAnalyzer_SoundUnit):
 
     def alloc_note(self, note):
         """alloc_note"""
-        note_address = self.note_queue_alloc()
-        self.note_queue[note_address] = note
-        return note_address
+        return self.voices.alloc(self.msg.channel, note)
 
     def analysis(
-        self, blind_time=False, blind_note=False, blind_note_info=False
+        self,
+        blind_time=False,
+        blind_note=False,
+        blind_note_info=False,
+        slot=None,
     ):
-        addr = self.alloc_note(self.msg.note)
+        """analysis, slot is the voice slot if already allocated"""
+        addr = self.alloc_note(self.msg.note) if slot is None else slot
         error, quantized_note = self.closest_note(self.msg.time, as_rest=True)
         info_quantization = ""
         if error is not None and not blind_note_info:
@@ -961,19 +2745,21 @@ class MidiMessageAnalyzer_note_off(MidiMessageAnalyzer_SoundUnit):
     """MidiMessageAnalyzer_note_off"""
 
     def free_note(self, note):
-        """alloc_note"""
-        addr = self.note_queue_find(note)
-        if addr is not None:
-            del self.note_queue[addr]
-        return addr
+        """free_note"""
+        return self.voices.free(self.msg.channel, note)
 
     def analysis(
         self,
         blind_time=False,
         blind_note=False,
         blind_note_info=False,
+        slot=None,
     ):
-        addr = self.free_note(self.msg.note)
+        """analysis, slot is the released voice slot (-1: none) if known"""
+        if slot is None:
+            addr = self.free_note(self.msg.note)
+        else:
+            addr = None if slot < 0 else slot
         color = None if addr is None else f"color({COLOR[addr % len(COLOR)]})"
 
         error, quantized_note = self.closest_note(
@@ -1048,16 +2834,22 @@ class MidiMessageAnalyzer_lyrics(
         length=0,
         encoding="utf-8",
         encoding_alternative="cp949",
+        text=None,
     ):
+        """text: already decoded lyric, then encoding is not detected"""
         self.msg = msg
         self.ppqn = ppqn
         self.tempo = tempo
         self.idx_info = f"[color(244)]{idx:4}[/color(244)]"
         self.length = length
-        self._init_encoding(
-            encoding=encoding, encoding_alternative=encoding_alternative
-        )
-        self.lyric = self.encoded_text.decode(self.encoding).strip()
+        if text is None:
+            self._init_encoding(
+                encoding=encoding, encoding_alternative=encoding_alternative
+            )
+            text = self.encoded_text.decode(self.encoding)
+        else:
+            self.encoding = encoding
+        self.lyric = text.strip()
         if not self.lyric:
             self.lyric = " "
 
@@ -1116,14 +2908,160 @@ class MidiMessageAnalyzer_lyrics(
         return result, self.lyric
 
 
+NoteColumns = namedtuple(
+    "NoteColumns",
+    [
+        "start_time",
+        "end_time",
+        "length",
+        "pitch",
+        "lyric",  # index in lyrics of each note
+        "lyrics",  # lyric string table
+    ],
+)
+
+
+def iter_notes(notes):
+    """note dicts of NoteColumns"""
+    lyrics = np.asarray(notes.lyrics).tolist()
+    for start_time, end_time, length, pitch, lyric in zip(
+        np.asarray(notes.start_time).tolist(),
+        np.asarray(notes.end_time).tolist(),
+        np.asarray(notes.length).tolist(),
+        np.asarray(notes.pitch).tolist(),
+        np.asarray(notes.lyric).tolist(),
+    ):
+        yield {
+            "start_time": start_time,
+            "end_time": end_time,
+            "length": length,
+            "pitch": pitch,
+            "lyric": lyrics[lyric],
+        }
+
+
+def _notes_from_dicts(notes):
+    lyrics = {}
+    columns = {"start_time": [], "end_time": [], "length": [], "pitch": []}
+    lyric_idx = []
+    for note in notes:
+        for name, values in columns.items():
+            values.append(note[name])
+        lyric_idx.append(lyrics.setdefault(note["lyric"], len(lyrics)))
+    return NoteColumns(
+        start_time=np.array(columns["start_time"], dtype=np.float64),
+        end_time=np.array(columns["end_time"], dtype=np.float64),
+        length=np.array(columns["length"], dtype=np.float64),
+        pitch=np.array(columns["pitch"], dtype=np.int64),
+        lyric=np.array(lyric_idx, dtype=np.int64),
+        lyrics=np.array(list(lyrics), dtype=str),
+    )
+
+
+def write_notes_json(file_path, notes):
+    """write notes as indented {"notes": [...]} json"""
+    with open(file_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"notes": list(iter_notes(notes))}, f, indent=4, ensure_ascii=False
+        )
+
+
+def write_notes_jsonl(file_path, notes):
+    """write notes as compact JSON Lines, one note per line"""
+    with open(file_path, "w", encoding="utf-8") as f:
+        for note in iter_notes(notes):
+            f.write(
+                json.dumps(note, ensure_ascii=False, separators=(",", ":"))
+            )
+            f.write("\n")
+
+
+def write_notes_npz(file_path, notes):
+    """write notes as uncompressed .npz columns, see read_notes_npz"""
+    with open(file_path, "wb") as f:
+        np.savez(f, **notes._asdict())
+
+
+def read_notes_json(file_path):
+    """read notes written by write_notes_json"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        return _notes_from_dicts(json.load(f)["notes"])
+
+
+def read_notes_jsonl(file_path):
+    """read notes written by write_notes_jsonl"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        return _notes_from_dicts(json.loads(line) for line in f if line)
+
+
+def read_notes_npz(file_path):
+    """read notes written by write_notes_npz
+
+    The arrays are memory mapped from the stored zip members instead of
+    being copied out of the archive.
+    """
+    arrays = {}
+    with zipfile.ZipFile(file_path) as archive, open(file_path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"compressed member {info.filename}")
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack(
+                "<HH", local_header[26:30]
+            )
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            name = info.filename.removesuffix(".npy")
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(
+                file_path,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return NoteColumns(**arrays)
+
+
+# writer: (suffix, write function)
+NOTE_WRITERS = {
+    "json": (".json", write_notes_json),
+    "jsonl": (".jsonl", write_notes_jsonl),
+    "npz": (".npz", write_notes_npz),
+}
+
+# suffix: read function
+NOTE_READERS = {
+    ".json": read_notes_json,
+    ".jsonl": read_notes_jsonl,
+    ".npz": read_notes_npz,
+}
+
+
+def read_notes(file_path):
+    """read notes of any NOTE_WRITERS output by its suffix"""
+    return NOTE_READERS[Path(file_path).suffix](file_path)
+
+
 def split_json_by_slience(json_path, min_length=6):
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    """split notes of to_json output by silence
+
+    json_path may be any NOTE_WRITERS output.
+    """
     result = []
     chunk = []
     chunk_length = 0
     start_data = False
-    for note in data["notes"]:
+    for note in iter_notes(read_notes(json_path)):
         if note["lyric"] == "J":
             start_data = True
             continue
@@ -1172,3 +3110,7 @@ def duration_secs_to_frames(note_duration_sec, sr, hop_length):
         note_duration_frame_int[i] += 1
 
     return note_duration_frame_int
+
+
+if __name__ == "__main__":
+    main()
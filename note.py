@@ -1,7 +1,11 @@
 """note rest information dictionary"""
 
+from bisect import bisect_left
 from collections import namedtuple
 from enum import Enum
+from functools import lru_cache
+
+import numpy as np
 
 DEFAULT_BPM = 120
 DEFAULT_TEMPO = 500000
@@ -12,6 +16,7 @@ DEFAULT_MEASURE_SPACE = 4
 NoteNamedTuple = namedtuple(
     "NoteNamedTuple", ["beat", "name_eng", "name_kor", "symbol", "name_short"]
 )
+DurationTable = namedtuple("DurationTable", ["ticks", "beats", "notes"])
 
 
 class Rest(Enum):
@@ -216,6 +221,59 @@ class Note_all(Enum):
     )
 
 
+@lru_cache(maxsize=None)
+def duration_table(ppqn, as_rest=False):
+    """Durations of Note_all (or Rest_all) sorted by ticks, cached per ppqn
+
+    Returns:
+        DurationTable(ticks, beats, notes), ticks and beats are ascending
+        arrays and notes the NoteNamedTuple of each duration
+    """
+    notes = sorted(
+        (note.value for note in (Rest_all if as_rest else Note_all)),
+        key=lambda note: note.beat,
+    )
+    beats = np.array([note.beat for note in notes], dtype=np.float64)
+    return DurationTable(beats * ppqn, beats, tuple(notes))
+
+
+def closest_duration(tick, ppqn, as_rest=False):
+    """nearest duration of tick, the longer one on a tie
+
+    Returns:
+        (error in beats, NoteNamedTuple), error is duration beat - beat
+    """
+    table = duration_table(ppqn, as_rest)
+    beat = tick / ppqn
+    idx = bisect_left(table.ticks, tick)
+    if idx == len(table.notes) or (
+        idx and beat - table.beats[idx - 1] < table.beats[idx] - beat
+    ):
+        idx -= 1
+    note = table.notes[idx]
+    return note.beat - beat, note
+
+
+def closest_durations(ticks, ppqn, as_rest=False):
+    """closest_duration of an array of ticks
+
+    Returns:
+        (duration ticks, index in duration_table(ppqn, as_rest).notes,
+        errors in beats)
+    """
+    table = duration_table(ppqn, as_rest)
+    beats = np.asarray(ticks) / ppqn
+    idx = np.searchsorted(table.ticks, ticks, side="left")
+    idx = np.minimum(idx, len(table.notes) - 1)
+    shorter = np.maximum(idx - 1, 0)
+    idx = np.where(
+        (idx > 0) & (beats - table.beats[shorter] < table.beats[idx] - beats),
+        shorter,
+        idx,
+    )
+    return table.ticks[idx], idx, table.beats[idx] - beats
+
+
 COLOR = (
     15,
     165,
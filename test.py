@@ -45,16 +45,93 @@ def test_bpm_estimator_librosa(audio_path):
     rprint(round(bpmlib.bpm_estimator_librosa(audio_path)[0]))
 
 
+def test_bpm_estimator_librosa_stream_blocks(audio_path):
+    """Test bpm_estimator_librosa_stream is the same over blocks and one block"""
+    bpm = bpmlib.bpm_estimator_librosa_stream(audio_path)
+    one_block_bpm = bpmlib.bpm_estimator_librosa_stream(
+        audio_path, block_duration=soundfile.info(audio_path).duration + 1
+    )
+    if not np.allclose(bpm, one_block_bpm):
+        raise ValueError(f"{audio_path}: {bpm} != {one_block_bpm}")
+    rprint(round(bpm[0]))
+
+
 def test_bpm_estimator_pretty_midi(midi_path):
     """Test bpm_estimator_pretty_midi"""
     rprint(round(bpmlib.bpm_estimator_pretty_midi(midi_path)))
 
 
+def test_bpm_candidates_librosa(audio_path):
+    """Test bpm_candidates_librosa"""
+    candidates = bpmlib.bpm_candidates_librosa(audio_path)
+    rprint(list(zip(candidates.bpms.round(), candidates.scores.round(3))))
+    rprint(bpmlib.tempo_changes(candidates))
+
+
 def test_get_bpm_from_midi(midi_path):
     """Test get_bpm_from_midi"""
     rprint(round(bpmlib.bpm_from_midi_file(midi_path)))
 
 
+def test_bpm_from_midi_file_scanner(midi_path):
+    """Test bpm_from_midi_file gives the same BPM as mido parsing"""
+    bpm = bpmlib.bpm_from_midi_file(midi_path)
+    mido_bpm = bpmlib.bpm_from_midi(mido.MidiFile(midi_path))
+    if bpm != mido_bpm:
+        raise ValueError(f"{midi_path}: {bpm} != {mido_bpm}")
+    rprint(bpm if bpm is None else round(bpm))  # None without set_tempo
+
+
+def test_midi_event_table(midi_path):
+    """Test MidiEventTable gives the same messages as mido parsing"""
+    _, _, tables = midia.read_event_tables(midi_path)
+    for table, track in zip(tables, mido.MidiFile(midi_path).tracks):
+        if list(table.to_track()) != list(track):
+            raise ValueError(f"{midi_path}: {track.name}")
+        note_num = np.count_nonzero(table.mask("note_on"))
+        rprint(f"{track.name}: {len(table)} events, {note_num} notes")
+
+
+def test_split_space_note_ticks(midi_path):
+    """Test split_space_note keeps note_off ticks of unmerged tracks
+
+    Removed gaps move into the next note_off, so with one tempo every
+    note_off keeps its absolute tick, whatever track the tempo is in.
+    Files with tempo changes are skipped, their gaps are converted back
+    to ticks by the tempo at each note_off.
+    """
+    ma = midia.MidiAnalyzer(midi_path)
+    if len(ma.tempo_map.tempos) > 1:
+        rprint(f"skip: {len(ma.tempo_map.tempos)} tempos")
+        return
+    note_off_ticks = [
+        table["tick"][table.mask("note_off")] for table in ma.event_tables
+    ]
+    ma.split_space_note(remove_silence_threshold=0.3)
+    for i, ticks in enumerate(note_off_ticks):
+        events = ma.track_analyzer(i).events
+        if not np.isin(ticks, events["tick"][events.mask("note_off")]).all():
+            raise ValueError(f"{midi_path}: track {i}")
+    rprint(f"{len(note_off_ticks)} tracks")
+
+
+def test_midi_stream_analyzer(midi_path):
+    """Test MidiStreamAnalyzer gives the records of a whole track analysis"""
+    ma = midia.MidiAnalyzer(midi_path, convert_1_to_0=True)
+    track_records = ma.track_analyzer(0).records()
+    stream_analyzer = midia.MidiStreamAnalyzer(ma.ppqn)
+    for (record, _), expected in zip(
+        stream_analyzer.analysis(iter(ma.track_analyzer(0).track)),
+        track_records.records,
+    ):
+        if record["slot"] != expected["slot"]:
+            raise ValueError(f"{midi_path}: {record['idx']}")
+    rprint(
+        f"lyric: {stream_analyzer.pop_lyric()}",
+        f"mean error: {stream_analyzer.mean_error:.4f}",
+    )
+
+
 def test_create_sample_midi1(midi_path):
     """test_sample_midi"""
     mid = mido.MidiFile()
@@ -775,8 +852,7 @@ def _conversion_gv_to_json(midi_path, dir_path):
     if os.path.exists(pathlib.Path(dir_path) / midi_path.name):
         return
     ma = midia.MidiAnalyzer(midi_path, convert_1_to_0=True)
-    ma.split_space_note(remove_silence_threshold=0.3)
-    ma.quantization(unit="32")
+    ma.normalize(remove_silence_threshold=0.3, unit="32")
     ma.to_json(dir_path=dir_path)
 
 